@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from . import story as synthetic, storage_server
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BLENDER_BIN = "/bin/blender" if sys.platform == "linux" else "/Applications/Blender.app/Contents/MacOS/Blender"
+
+# the metrics compared between runs, a higher value is a regression for all
+METRICS = ('generate.seconds', 'generate.peak_rss', 'generate.blend_bytes',
+           'render.seconds', 'render.peak_rss')
+
+
+def run_blender(blender, script, args, env, blend=None, check=True):
+    # wall time and peak resident memory of one blender process
+    start = time.monotonic()
+    proc = subprocess.Popen([blender, "--background"] + ([blend] if blend else []) + ["--python-exit-code", "1",
+                                                                                    "--python", os.path.join(REPO_ROOT, script), "--"] + args,
+                            cwd=REPO_ROOT, env=env)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.monotonic() - start
+
+    if check and os.waitstatus_to_exitcode(status) != 0:
+        raise Exception("{} failed".format(script))
+
+    # ru_maxrss is in kilobytes on linux
+    return {'seconds': round(seconds, 3), 'peak_rss': usage.ru_maxrss * 1024}
+
+
+def read_spans(trace_file):
+    if not os.path.exists(trace_file):
+        return []
+
+    with open(trace_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def git_revision():
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    return proc.stdout.decode().strip() or None
+
+
+def benchmark(args, workdir):
+    storage_root = os.path.join(workdir, 'storage')
+    workspace = os.path.join(workdir, 'workspace')
+    os.makedirs(workspace)
+
+    builder = synthetic.StoryBuilder(storage_root, seed=args.seed,
+                                     image_size=tuple(int(x) for x in args.image_size.split('x')),
+                                     speech_seconds=(args.speech_min, args.speech_max))
+    if args.kind == 'summary':
+        story = synthetic.summary_story(builder, blocks=args.blocks,
+                                        mix=[t for t in args.mix if t != 'video'])
+    else:
+        story = synthetic.scene_story(builder, blocks=args.blocks, directions=args.directions, mix=args.mix)
+
+    story_path = os.path.join(workdir, 'story.json')
+    with open(story_path, 'w') as f:
+        json.dump(story, f)
+
+    server = storage_server.serve(storage_root)
+    trace_file = os.path.join(workdir, 'trace.jsonl')
+
+    env = dict(os.environ,
+               SUPABASE_URL="http://127.0.0.1:{}".format(server.server_port),
+               SUPABASE_SERVICE_ROLE_KEY='benchmark',
+               STORAGE_RESUMABLE_THRESHOLD=str(1024 ** 4),
+               ASSET_WORKSPACE=workspace,
+               WEAVER_TRACE_FILE=trace_file,
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    env.pop('ENV', None)
+
+    if args.cold:
+        # nothing carried over from earlier runs
+        env['ASSET_CACHE_DIR'] = os.path.join(workdir, 'cache')
+        env['RENDER_CACHE_DIR'] = os.path.join(workdir, 'render-cache')
+
+    blend = os.path.join(workdir, 'output.blend')
+    output = os.path.join(workdir, 'output.mp4')
+
+    try:
+        if args.kind == 'summary':
+            generate = run_blender(args.blender, 'generate_summary.py',
+                                   ["--library", "common.blend", "--story", story_path, "--resolution", args.resolution,
+                                    "--output", blend, "--pack_policy", args.pack_policy], env)
+        else:
+            generate = run_blender(args.blender, 'generate_scene.py',
+                                   ["--library", "common.blend", "--story", story_path, "--resolution", args.resolution,
+                                    "--blend_output", blend, "--pack_policy", args.pack_policy,
+                                    "--workers", str(args.scene_workers)], env)
+        generate['blend_bytes'] = os.path.getsize(blend)
+
+        result = {'generate': generate}
+
+        if args.parity:
+            # composited frames against eevee renders of the same frames
+            run_blender(args.blender, 'render_story.py',
+                        ["--parity", "--output", output, "--profile", args.profile], env, blend=blend, check=False)
+
+            with open('{}.parity.json'.format(output), 'r') as f:
+                report = json.load(f)
+
+            result['parity'] = {
+                'frames': len(report),
+                'failed': sum(1 for frame in report if not frame['ok']),
+                'worst_differing_pixels': max((frame['differing_pixels'] for frame in report), default=None),
+            }
+
+        if args.calibrate:
+            # updates weaver_blender/calibration.json for this blender,
+            # resolution and profile
+            run_blender(args.blender, 'render_story.py',
+                        ["--calibrate", "--output", output, "--profile", args.profile], env, blend=blend)
+
+        if not args.skip_render:
+            render_args = ["--output", output, "--profile", args.profile]
+            if args.pipe:
+                render_args.append("--pipe")
+
+            render = run_blender(args.blender, 'render_story.py', render_args, env, blend=blend)
+
+            frames = sum(span.get('frames', 0) for span in read_spans(trace_file)
+                         if span['name'] == 'render_scene')
+            render['frames'] = frames
+            render['fps'] = round(frames / render['seconds'], 3) if render['seconds'] else None
+            render['output_bytes'] = os.path.getsize(output)
+            result['render'] = render
+
+        totals = {}
+        for span in read_spans(trace_file):
+            totals[span['name']] = round(totals.get(span['name'], 0) + span['seconds'], 4)
+        result['phases'] = totals
+    finally:
+        server.shutdown()
+
+    return result
+
+
+def metric(result, name):
+    value = result
+    for part in name.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+
+    return value
+
+
+def compare(results_path, result, threshold):
+    # against the latest earlier run with the same parameters
+    baseline = None
+    if os.path.exists(results_path):
+        with open(results_path, 'r') as f:
+            for line in f:
+                previous = json.loads(line)
+                if previous['params'] == result['params']:
+                    baseline = previous
+
+    if baseline is None:
+        print('no earlier run with these parameters to compare against')
+        return []
+
+    regressions = []
+    for name in METRICS:
+        before, after = metric(baseline, name), metric(result, name)
+        if not before or after is None:
+            continue
+
+        change = (after - before) / before
+        print('{:24} {:>14} -> {:>14} {:+.1%}'.format(name, before, after, change))
+
+        if change > threshold:
+            regressions.append(name)
+
+    return regressions
+
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blender', type=str, required=False,
+                        help='blender binary', default=BLENDER_BIN)
+    parser.add_argument('--kind', type=str, required=False, choices=('scene', 'summary'),
+                        help='which generate script and story format to benchmark', default='scene')
+    parser.add_argument('--blocks', type=int, required=False, default=5)
+    parser.add_argument('--directions', type=int, required=False,
+                        help='directions per scene block', default=4)
+    parser.add_argument('--mix', type=str, nargs='+', required=False, choices=synthetic.DIRECTION_TYPES,
+                        help='direction types to draw from', default=list(synthetic.DIRECTION_TYPES))
+    parser.add_argument('--speech_min', type=float, required=False, default=4)
+    parser.add_argument('--speech_max', type=float, required=False, default=8)
+    parser.add_argument('--image_size', type=str, required=False, default='1280x720')
+    parser.add_argument('--resolution', type=str, required=False, default='1080x1920')
+    parser.add_argument('--profile', type=str, required=False, default='final')
+    parser.add_argument('--pack_policy', type=str, required=False, default='packed')
+    parser.add_argument('--pipe', action='store_true', default=False)
+    parser.add_argument('--scene_workers', type=int, required=False,
+                        help='blender processes building scene blocks', default=1)
+    parser.add_argument('--skip_render', action='store_true', default=False)
+    parser.add_argument('--parity', action='store_true', default=False,
+                        help='check the composite backend against eevee, fails when any frame differs or none were compared')
+    parser.add_argument('--calibrate', action='store_true', default=False,
+                        help='calibrate eevee samples for this resolution and profile before rendering')
+    parser.add_argument('--cold', action='store_true', default=False,
+                        help='use empty asset and render caches')
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    parser.add_argument('--label', type=str, required=False,
+                        help='name for this run in the results file')
+    parser.add_argument('--results', type=str, required=False,
+                        help='results file, one JSON run per line', default='benchmark-results.jsonl')
+    parser.add_argument('--threshold', type=float, required=False,
+                        help='fail when a metric grows by more than this fraction', default=0.1)
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help='keep the working directory')
+
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='weaver-benchmark-')
+    try:
+        measured = benchmark(args, workdir)
+    finally:
+        if args.keep:
+            print('working directory kept at {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    params = {name: getattr(args, name) for name in (
+        'kind', 'blocks', 'directions', 'mix', 'speech_min', 'speech_max', 'image_size',
+        'resolution', 'profile', 'pack_policy', 'pipe', 'scene_workers', 'skip_render', 'parity', 'calibrate',
+        'cold', 'seed')}
+
+    result = dict(measured, label=args.label, revision=git_revision(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'), params=params)
+
+    regressions = compare(args.results, result, args.threshold)
+
+    if 'parity' in result and (result['parity']['failed'] or not result['parity']['frames']):
+        regressions.append('parity')
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    if regressions:
+        print('regressed: {}'.format(', '.join(regressions)))
+        sys.exit(1)
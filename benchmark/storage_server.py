@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import threading
+from urllib.parse import urlsplit, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# enough of the Supabase storage API for weaver_blender.storage: signing,
+# bulk signing, signed GET/HEAD with ranges and ETags, and plain uploads.
+# Resumable (TUS) uploads aren't served, benchmarks raise
+# STORAGE_RESUMABLE_THRESHOLD above anything they upload.
+
+
+def file_etag(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+
+    return '"{}"'.format(md5.hexdigest())
+
+
+class StorageHandler(BaseHTTPRequestHandler):
+    root = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def object_path(self, bucket, key):
+        path = os.path.realpath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.realpath(self.root) + os.sep):
+            raise ValueError("key outside storage root")
+
+        return path
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def route(self):
+        parts = unquote(urlsplit(self.path).path).split('/')
+        # ['', 'storage', 'v1', 'object', ...]
+        if parts[1:4] != ['storage', 'v1', 'object']:
+            return None, None, None
+
+        if parts[4] == 'sign':
+            return 'sign', parts[5], '/'.join(parts[6:])
+
+        return 'object', parts[4], '/'.join(parts[5:])
+
+    def do_POST(self):
+        kind, bucket, key = self.route()
+        body = self.read_body()
+
+        if kind == 'sign' and not key:
+            signed = []
+            for path in json.loads(body)['paths']:
+                if os.path.exists(self.object_path(bucket, path)):
+                    signed.append({'path': path, 'signedURL': '/object/sign/{}/{}?token=benchmark'.format(bucket, path),
+                                   'error': None})
+                else:
+                    signed.append({'path': path, 'signedURL': None, 'error': 'not found'})
+
+            return self.send_json(200, signed)
+
+        if kind == 'sign':
+            if not os.path.exists(self.object_path(bucket, key)):
+                return self.send_json(404, {'error': 'not found'})
+
+            return self.send_json(200, {'signedURL': '/object/sign/{}/{}?token=benchmark'.format(bucket, key)})
+
+        if kind == 'object':
+            path = self.object_path(bucket, key)
+            if os.path.exists(path) and self.headers.get('X-Upsert') != 'true':
+                return self.send_json(409, {'error': 'exists'})
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(body)
+
+            return self.send_json(200, {'Key': '{}/{}'.format(bucket, key)})
+
+        self.send_json(404, {'error': 'unknown endpoint'})
+
+    def send_object(self, head):
+        kind, bucket, key = self.route()
+        if kind != 'sign' or not key:
+            return self.send_json(404, {'error': 'unknown endpoint'})
+
+        path = self.object_path(bucket, key)
+        if not os.path.exists(path):
+            return self.send_json(404, {'error': 'not found'})
+
+        size = os.path.getsize(path)
+        start = 0
+        status = 200
+
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', file_etag(path))
+        self.send_header('Content-Length', str(size - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        self.end_headers()
+
+        if head:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                self.wfile.write(chunk)
+
+    def do_GET(self):
+        self.send_object(head=False)
+
+    def do_HEAD(self):
+        self.send_object(head=True)
+
+
+def serve(root, port=0):
+    # returns the running server, its url is http://127.0.0.1:<server_port>
+    handler = type('BoundStorageHandler', (StorageHandler,), {'root': root})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
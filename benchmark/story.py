@@ -0,0 +1,176 @@
+import os
+import math
+import wave
+import zlib
+import random
+import struct
+import subprocess
+
+
+DIRECTION_TYPES = ('image', 'screenshot', 'text', 'video')
+LOCATIONS = ('top', 'bottom', 'center', 'left', 'right')
+
+SAMPLE_RATE = 44100
+WORDS = ('render', 'scene', 'story', 'frame', 'asset', 'video', 'weaver', 'stage', 'camera', 'block')
+
+
+def write_png(path, width, height, seed):
+    # vertical gradient, incompressible enough that size scales with pixels
+    rng = random.Random(seed)
+    top = [rng.randrange(256) for _ in range(3)]
+    bottom = [rng.randrange(256) for _ in range(3)]
+
+    rows = []
+    for y in range(height):
+        t = y / max(1, height - 1)
+        color = bytes(int(a + (b - a) * t) for a, b in zip(top, bottom))
+        noise = bytes(rng.randrange(256) for _ in range(16))
+        row = bytearray(color * width)
+        row[:len(noise)] = noise
+        rows.append(b'\0' + bytes(row))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(b''.join(rows), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_wav(path, seconds, seed):
+    frequency = 220 + (seed % 8) * 55
+
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(b''.join(
+            struct.pack('<h', int(8000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)))
+            for i in range(int(seconds * SAMPLE_RATE))))
+
+
+def write_video(path, seconds, width, height):
+    proc = subprocess.run([
+        'ffmpeg',
+        '-f', 'lavfi', '-i', 'testsrc=size={}x{}:rate=30'.format(width, height),
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate={}'.format(SAMPLE_RATE),
+        '-t', str(seconds),
+        '-c:v', 'libx264',
+        '-c:a', 'aac',
+        '-y',
+        path
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    if proc.returncode != 0:
+        raise Exception("error generating {}".format(path))
+
+
+class StoryBuilder:
+    # writes assets into a storage root laid out as <root>/<bucket>/<key>
+    def __init__(self, storage_root, seed=0, image_size=(1280, 720), speech_seconds=(4, 8)):
+        self.storage_root = storage_root
+        self.rng = random.Random(seed)
+        self.image_size = image_size
+        self.speech_seconds = speech_seconds
+        self.count = 0
+
+    def asset_path(self, key):
+        path = os.path.join(self.storage_root, 'assets', key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def next_key(self, extension):
+        self.count += 1
+        return "benchmark/{}.{}".format(self.count, extension)
+
+    def image(self):
+        key = self.next_key('png')
+        write_png(self.asset_path(key), self.image_size[0], self.image_size[1], self.count)
+        return key
+
+    def speech(self):
+        seconds = self.rng.uniform(*self.speech_seconds)
+        key = self.next_key('wav')
+        write_wav(self.asset_path(key), seconds, self.count)
+        return key, seconds
+
+    def text(self):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(2, 5)))
+
+    def video(self, seconds):
+        key = self.next_key('mp4')
+        write_video(self.asset_path(key), seconds, *self.image_size)
+        return key
+
+
+def scene_story(builder, blocks=5, directions=4, mix=DIRECTION_TYPES):
+    # the generate_scene.py format: blocks with staged directions tagged
+    # against their narration
+    story = {'metadata': {}, 'blocks': []}
+    rng = builder.rng
+
+    for b in range(blocks):
+        speech_key, speech_seconds = builder.speech()
+        block = {
+            'id': 'block-{}'.format(b),
+            'speech': {'asset': {'key': speech_key}, 'tags': {}},
+            'stage': {'directions': []},
+        }
+
+        if 'video' in mix and rng.random() < 1 / len(mix):
+            video_id = 'video-{}'.format(b)
+            video_seconds = speech_seconds + 2
+            story['metadata'][video_id] = {
+                'key': builder.video(video_seconds),
+                'transcription': {
+                    'a': {'start': 0.0, 'end': video_seconds / 2},
+                    'b': {'start': video_seconds / 2, 'end': video_seconds},
+                },
+            }
+            block['stage']['directions'].append(
+                {'type': 'video', 'data': {'id': video_id, 'segments': ['a', 'b']}})
+        else:
+            for i in range(directions):
+                kind = rng.choice([t for t in mix if t != 'video'] or ['text'])
+                location = 'background' if i == 0 and kind != 'text' else rng.choice(LOCATIONS)
+
+                if kind == 'text':
+                    direction = {'type': 'text', 'data': builder.text(), 'location': location}
+                else:
+                    direction = {'type': kind, 'asset': {'key': builder.image()}, 'location': location}
+
+                block['stage']['directions'].append(direction)
+
+                if location != 'background':
+                    block['speech']['tags'][str(i)] = {
+                        'timeOffset': round(speech_seconds * i / (directions + 1), 3)}
+
+        story['blocks'].append(block)
+
+    return story
+
+
+def summary_story(builder, blocks=5, mix=('image', 'screenshot', 'text')):
+    # the generate_summary.py format: one asset or plain narration per block
+    story = {'metadata': {'title': builder.text()}, 'assets': {}, 'blocks': []}
+
+    for b in range(blocks):
+        speech_key, _ = builder.speech()
+        kind = builder.rng.choice(mix)
+        block = {
+            'id': 'block-{}'.format(b),
+            'type': kind,
+            'speech': {'asset': {'key': speech_key}},
+            'arguments': {},
+        }
+
+        if kind in ('image', 'screenshot'):
+            asset_id = 'asset-{}'.format(b)
+            story['assets'][asset_id] = {'id': asset_id, 'storage': {'key': builder.image()}}
+            block['arguments']['image_id' if kind == 'image' else 'url_id'] = asset_id
+
+        story['blocks'].append(block)
+
+    return story
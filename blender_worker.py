@@ -0,0 +1,95 @@
+import bpy
+import os
+import sys
+import json
+import runpy
+import socket
+import argparse
+import traceback
+from weaver_blender import tracing
+
+
+def resident_memory():
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_command(command):
+    if command.get('blend'):
+        bpy.ops.wm.open_mainfile(filepath=command['blend'])
+
+    # per job settings, e.g. the job's workspace and the trace to report
+    # spans to, put back afterwards
+    env = command.get('env', {})
+    previous = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+
+    # the stage scripts read their arguments after '--'
+    sys.argv = [bpy.app.binary_path, '--python',
+                command['script'], '--'] + command['args']
+
+    try:
+        with tracing.transaction(os.path.splitext(os.path.basename(command['script']))[0]):
+            runpy.run_path(command['script'], run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise Exception("{} exited with {}".format(
+                command['script'], e.code))
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, required=True,
+                        help='unix socket to accept jobs on')
+    parser.add_argument('--max_jobs', type=int, required=False,
+                        help='exit after this many jobs', default=50)
+    parser.add_argument('--max_memory', type=int, required=False,
+                        help='exit once resident memory passes this many bytes', default=8 * 1024 ** 3)
+
+    args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(1)
+
+    jobs = 0
+    recycle = False
+
+    print('blender worker ready')
+
+    while not recycle:
+        conn, _ = server.accept()
+
+        with conn, conn.makefile('rw') as stream:
+            command = json.loads(stream.readline())
+
+            try:
+                run_command(command)
+                result = {'ok': True}
+            except Exception as e:
+                traceback.print_exc()
+                result = {'ok': False, 'error': str(e)}
+
+            # back to a clean slate for the next job
+            bpy.ops.wm.read_factory_settings()
+
+            jobs += 1
+            recycle = jobs >= args.max_jobs or resident_memory() > args.max_memory
+            result['recycle'] = recycle
+
+            stream.write(json.dumps(result) + '\n')
+            stream.flush()
+
+    server.close()
+    os.remove(args.socket)
+
+    print('blender worker recycling after {} jobs'.format(jobs))
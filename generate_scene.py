@@ -6,9 +6,9 @@ import os
 import math
 import json
 import subprocess
-import requests
 import sentry_sdk
-from weaver_blender import layout
+from concurrent.futures import ThreadPoolExecutor
+from weaver_blender import layout, packing, prefetch, profiles, render, render_cache, storage, templates, timeline, tracing, transcode
 
 
 if os.environ.get('ENV') == 'production':
@@ -22,53 +22,174 @@ if os.environ.get('ENV') == 'production':
     )
 
 
-supabase_url = os.environ["SUPABASE_URL"]
-service_role_key = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 asset_workspace = os.environ.get('ASSET_WORKSPACE', '/tmp')
 library_path = os.path.join(os.path.dirname(__file__), 'library')
 
 
-def download_storage_object(bucket, storage_key, output_path):
-    res = requests.post(
-        "{}/storage/v1/object/sign/{}/{}".format(
-            supabase_url, bucket, storage_key),
-        headers={
-            'Authorization': 'Bearer {}'.format(service_role_key),
-            'Content-Type': 'application/json',
-        },
-        json={
-            "expiresIn": 120,
-        }
-    )
+def build_sequence_strips(block_plan, video_scene, sequence_scene, assets, transcodes):
+    # the block's strips in the Sequence scene, where the timeline put them
+    for strip in block_plan.strips:
+        if strip.kind == 'scene':
+            sequence_scene.sequence_editor.sequences.new_scene(
+                name=strip.name, scene=video_scene, channel=strip.channel, frame_start=strip.frame_start)
+        elif strip.kind == 'sound' and strip.key is not None:
+            speech_file = prefetch.wait_for_asset(assets, strip.key)
+            audio_frame_end = layout.add_audio(
+                strip.name, speech_file, sequence_scene, strip.frame_start, library_path)
+
+            if audio_frame_end != strip.frame_end:
+                print('{} is {} frames, planned {}'.format(
+                    strip.name, audio_frame_end - strip.frame_start, strip.frames))
+        elif strip.kind == 'sound':
+            # segment files start at the segment, no trimming needed
+            sequence_scene.sequence_editor.sequences.new_sound(
+                name=strip.name, filepath=transcodes[block_plan.id][strip.segment].result(),
+                channel=strip.channel, frame_start=strip.frame_start)
+            sequence = sequence_scene.sequence_editor.sequences_all[strip.name]
+            sequence.frame_final_duration = strip.frames
+        elif strip.kind == 'movie':
+            sequence_scene.sequence_editor.sequences.new_movie(
+                name=strip.name, filepath=transcodes[block_plan.id][strip.segment].result(),
+                channel=strip.channel, frame_start=strip.frame_start, fit_method='FILL')
+            sequence = sequence_scene.sequence_editor.sequences_all[strip.name]
+
+            # drop anything past the segment, then stretch it over the narration
+            sequence.frame_offset_end = sequence.frame_duration - \
+                (strip.trim_end - strip.trim_start)
+            sequence.speed_factor = sequence.frame_final_duration / strip.frames
+
+            sequence.frame_start += strip.frame_start - sequence.frame_final_start
+
+
+def block_asset_versions(story, block, assets):
+    # the version of every asset the block uses, a re-uploaded asset renders
+    # differently under the same key
+    return {storage_key: storage.downloaded_etag(prefetch.wait_for_asset(assets, storage_key, bucket))
+            for bucket, storage_key, _ in prefetch.story_asset_keys(dict(story, blocks=[block]), asset_workspace)}
+
+
+def build_block_scene(story, block, block_plan, assets, asset_versions, resolution, fps):
+    # the block's Video scene, everything in it comes from the story and the
+    # plan so blocks can be built in any order or process
+    res_x, res_y = [int(x) for x in resolution.split('x')]
+
+    video_scene = bpy.data.scenes.new(block_plan.scene_name)
+
+    video_scene.view_settings.view_transform = 'Standard'
+    video_scene.render.fps = fps
+    video_scene.render.resolution_x = res_x
+    video_scene.render.resolution_y = res_y
+    video_scene.render.sequencer_gl_preview = 'MATERIAL'
+
+    bpy.context.window.scene = video_scene
+
+    scene_camera = bpy.data.objects.new("SceneCameraControl", None)
+    scene_camera_ob = bpy.data.objects.new(
+        "SceneCamera", bpy.data.cameras.new("SceneCamera"))
+    scene_camera_ob.parent = scene_camera
+    scene_camera_ob.location = (20, 0, 0)
+    scene_camera_ob.rotation_euler = (
+        math.pi / 2, math.pi / 2, math.pi / 2)
+    video_scene.collection.objects.link(scene_camera)
+    video_scene.collection.objects.link(scene_camera_ob)
+    video_scene.camera = scene_camera_ob
+
+    if 'colors' in story['metadata']:
+        bg = story['metadata']['colors']['background']
+        tc = story['metadata']['colors']['text']
+
+        bg_color = (bg['r']/255.0, bg['g']/255.0, bg['b']/255.0, 1.0)
+        text_color = (tc['r']/255.0, tc['g']/255.0, tc['b']/255.0, 1.0)
+    else:
+        bg_color = (1.0, 1.0, 1.0, 1.0)
+        text_color = (0.0, 0.0, 0.0, 1.0)
+
+    world = bpy.data.worlds.new("World")
+    world.use_nodes = True
+    world.node_tree.nodes.clear()
+    world_emission = world.node_tree.nodes.new("ShaderNodeEmission")
+    world_emission.inputs[0].default_value = bg_color
+    world_output = world.node_tree.nodes.new("ShaderNodeOutputWorld")
+    world.node_tree.links.new(
+        world_emission.outputs[0], world_output.inputs[0])
+    video_scene.world = world
+
+    text_material = templates.emission_material(text_color)
+
+    print('generating scene')
+
+    directions = block['stage']['directions']
+
+    # everything that affects how this block renders, see render_cache;
+    # text placement carries over from the previous blocks. assets without
+    # a version can't be told apart, always render those
+    if None not in asset_versions.values():
+        video_scene['content_hash'] = render_cache.content_hash(
+            'scene', block, story['metadata'].get('colors'),
+            [story['metadata'][d['data']['id']]
+                for d in directions if d['type'] == 'video'],
+            asset_versions, block_plan.text_position, resolution)
+
+    if block_plan.kind == 'scene':
+        video_scene.frame_end = block_plan.scene_frame_end
+
+        # create stage, animate in camera
+        stage = layout.add_stage(
+            block['id'], video_scene, block_plan.stage_location)
+
+        bpy.context.evaluated_depsgraph_get().update()
+
+        camera = stage["camera"]
+        scene_camera.matrix_world = camera.matrix_world
+        for frame in block_plan.camera_frames:
+            scene_camera.keyframe_insert("location", frame=frame)
+            scene_camera.keyframe_insert("rotation_euler", frame=frame)
+
+        for placement in block_plan.placements:
+            if placement.kind == 'image':
+                asset_file = prefetch.wait_for_asset(assets, placement.key)
+                layout.add_image(library_path, asset_file, video_scene, stage, placement.location,
+                                 placement.frame_start, placement.frame_end, placement.key)
+            else:
+                layout.add_text(library_path, placement.text, video_scene, stage, placement.location,
+                                placement.frame_start, placement.frame_end, text_material)
 
-    if res.status_code != 200:
-        print(res.text)
-        raise Exception("error getting signed url")
+    return video_scene
 
-    res_data = res.json()
-    image_url = res_data['signedURL']
 
-    fileRes = requests.get(
-        "{}/storage/v1/{}".format(supabase_url, image_url))
+def build_block_blend(args, story, block, block_plan, assets):
+    # in its own blender process, once the block's assets are in; assets
+    # shared between blocks were downloaded once, to the first block's path,
+    # so the worker gets the paths rather than working them out again, and
+    # the versions this process downloaded
+    asset_paths = [(bucket, storage_key, prefetch.wait_for_asset(assets, storage_key, bucket))
+                   for bucket, storage_key, _ in prefetch.story_asset_keys(dict(story, blocks=[block]), asset_workspace)]
 
-    with open(output_path, "wb") as f:
-        f.write(fileRes.content)
+    assets_path = "{}/{}.assets.json".format(asset_workspace, block['id'])
+    with open(assets_path, 'w') as f:
+        json.dump({'paths': asset_paths,
+                   'versions': block_asset_versions(story, block, assets)}, f)
 
+    blend = "{}/{}.block.blend".format(asset_workspace, block['id'])
+    proc = subprocess.run([bpy.app.binary_path, "--background", "--python-exit-code", "1",
+                           "--python", os.path.abspath(__file__), "--",
+                           "--library", args.library, "--story", args.story, "--resolution", args.resolution,
+                           "--block", str(block_plan.index), "--assets", assets_path, "--blend_output", blend])
+    os.remove(assets_path)
 
-current_text_position = 'top'
+    if proc.returncode != 0:
+        raise Exception("error building block {}".format(block['id']))
 
+    return blend
 
-def next_text_position():
-    global current_text_position
 
-    if current_text_position == 'center':
-        current_text_position = 'bottom'
-    elif current_text_position == 'bottom':
-        current_text_position = 'top'
-    else:
-        current_text_position = 'center'
+def append_block_scene(blend, scene_name):
+    with bpy.data.libraries.load(blend) as (data_from, data_to):
+        data_to.scenes = [scene_name]
+
+    os.remove(blend)
 
-    return current_text_position
+    return data_to.scenes[0]
 
 
 if '__main__' == __name__:
@@ -77,19 +198,66 @@ if '__main__' == __name__:
                         help='path to library')
     parser.add_argument('--story', type=str, required=True,
                         help='path to story descriptor JSON')
-    parser.add_argument('--output', type=str, required=True,
-                        help='output path', default='/tmp/output.mp4')
-    parser.add_argument('--blend_output', type=str, required=True,
-                        help='output path', default='/tmp/output.blend')
+    parser.add_argument('--output', type=str, required=False,
+                        help='render the story to this path in the same process')
+    parser.add_argument('--blend_output', type=str, required=False,
+                        help='.blend output path, only written when given')
+    parser.add_argument('--pack_policy', type=str, required=False, choices=packing.PACK_POLICIES,
+                        help='how images are stored in the .blend', default='packed')
+    parser.add_argument('--profile', type=str, required=False, choices=profiles.PROFILES.keys(),
+                        help='render quality profile', default=profiles.DEFAULT_PROFILE)
     parser.add_argument('--resolution', type=str, required=False,
                         help='output path', default='1920x1080')
+    parser.add_argument('--workers', type=int, required=False,
+                        help='build staged blocks in this many blender processes, 1 builds everything in this one',
+                        default=int(os.environ.get('SCENE_WORKERS', 1)))
+    parser.add_argument('--block', type=int, required=False,
+                        help='index of the block to build as a worker')
+    parser.add_argument('--assets', type=str, required=False,
+                        help='downloaded assets of the block, as a worker')
 
     args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
 
+    tracing.begin('generate_scene')
+
     with open(args.story, 'r') as f:
         story = json.load(f)
 
-    bpy.ops.preferences.addon_enable(module='io_import_images_as_planes')
+    if args.block is not None:
+        # block worker, build one Video scene into its own .blend and exit;
+        # the parent has downloaded the assets and planned the timeline
+        block = story['blocks'][args.block]
+        with open(args.assets, 'r') as f:
+            block_assets = json.load(f)
+        assets = prefetch.resolved_assets(block_assets['paths'])
+        plan = timeline.load_or_plan(args.story, story, None)
+
+        with tracing.span('build_scene', block=block['id']):
+            build_block_scene(story, block, plan.blocks[args.block], assets, block_assets['versions'],
+                              args.resolution, plan.fps)
+            bpy.ops.wm.save_as_mainfile(filepath=args.blend_output)
+
+        sys.exit(0)
+
+    assets = prefetch.prefetch_story_assets(
+        story, asset_workspace, storage.download_storage_object, sign=storage.sign_storage_objects)
+
+    # cut and normalize only the video segments we use, alongside scene building
+    transcodes = {}
+    for block in story['blocks']:
+        for direction in block['stage']['directions']:
+            if direction['type'] == 'video':
+                video_metadata = story["metadata"][direction["data"]["id"]]
+                transcodes[block["id"]] = transcode.transcode_segments(
+                    assets[('assets', video_metadata["key"])], video_metadata["key"],
+                    {segment: video_metadata["transcription"][segment]
+                        for segment in direction["data"]["segments"]},
+                    "{}/{}".format(asset_workspace, block["id"]), storage.downloaded_etag)
+                break
+
+    # every frame range up front, from the story and its speech durations
+    plan = timeline.load_or_plan(
+        args.story, story, lambda key: prefetch.wait_for_asset(assets, key))
 
     res_x, res_y = [int(x) for x in args.resolution.split('x')]
 
@@ -97,270 +265,39 @@ if '__main__' == __name__:
     sequence_scene.sequence_editor_create()
 
     sequence_scene.view_settings.view_transform = 'Standard'
-    sequence_scene.render.fps = 30
+    sequence_scene.render.fps = plan.fps
     sequence_scene.render.resolution_x = res_x
     sequence_scene.render.resolution_y = res_y
     sequence_scene.render.sequencer_gl_preview = 'MATERIAL'
 
-    current_frame = 1
-
-    for bi, block in enumerate(story['blocks']):
-        video_scene = bpy.data.scenes.new('Video')
-
-        video_scene.view_settings.view_transform = 'Standard'
-        video_scene.render.fps = 30
-        video_scene.render.resolution_x = res_x
-        video_scene.render.resolution_y = res_y
-        video_scene.render.sequencer_gl_preview = 'MATERIAL'
-
-        bpy.context.window.scene = video_scene
-
-        scene_camera = bpy.data.objects.new("SceneCameraControl", None)
-        scene_camera_ob = bpy.data.objects.new(
-            "SceneCamera", bpy.data.cameras.new("SceneCamera"))
-        scene_camera_ob.parent = scene_camera
-        scene_camera_ob.location = (20, 0, 0)
-        scene_camera_ob.rotation_euler = (
-            math.pi / 2, math.pi / 2, math.pi / 2)
-        video_scene.collection.objects.link(scene_camera)
-        video_scene.collection.objects.link(scene_camera_ob)
-        video_scene.camera = scene_camera_ob
-
-        if 'colors' in story['metadata']:
-            bg = story['metadata']['colors']['background']
-            tc = story['metadata']['colors']['text']
-
-            bg_color = (bg['r']/255.0, bg['g']/255.0, bg['b']/255.0, 1.0)
-            text_color = (tc['r']/255.0, tc['g']/255.0, tc['b']/255.0, 1.0)
+    builds = {}
+    if args.workers > 1:
+        # staged blocks in parallel, each in its own process, and appended
+        # here in story order
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        builds = {block_plan.index: executor.submit(build_block_blend, args, story, block, block_plan, assets)
+                  for block, block_plan in zip(story['blocks'], plan.blocks) if block_plan.kind == 'scene'}
+        executor.shutdown(wait=False)
+
+    for block, block_plan in zip(story['blocks'], plan.blocks):
+        block_started = tracing.now()
+
+        if block_plan.index in builds:
+            video_scene = append_block_scene(
+                builds[block_plan.index].result(), block_plan.scene_name)
         else:
-            bg_color = (1.0, 1.0, 1.0, 1.0)
-            text_color = (0.0, 0.0, 0.0, 1.0)
-
-        world = bpy.data.worlds.new("World")
-        world.use_nodes = True
-        world.node_tree.nodes.clear()
-        world_emission = world.node_tree.nodes.new("ShaderNodeEmission")
-        world_emission.inputs[0].default_value = bg_color
-        world_output = world.node_tree.nodes.new("ShaderNodeOutputWorld")
-        world.node_tree.links.new(
-            world_emission.outputs[0], world_output.inputs[0])
-        video_scene.world = world
-
-        text_material = bpy.data.materials.new("TextMaterial")
-        text_material.use_nodes = True
-        text_material.node_tree.nodes.clear()
-        text_emission = text_material.node_tree.nodes.new("ShaderNodeEmission")
-        text_emission.inputs[0].default_value = text_color
-        text_output = text_material.node_tree.nodes.new(
-            "ShaderNodeOutputMaterial")
-        text_material.node_tree.links.new(
-            text_emission.outputs[0], text_output.inputs[0])
-
-        print('generating scene')
-
-        buffer_frames = 30
-
-        directions = block['stage']['directions']
-        video_direction = None
-
-        for direction in directions:
-            if direction['type'] == 'video':
-                video_direction = direction
-                break
+            video_scene = build_block_scene(
+                story, block, block_plan, assets, block_asset_versions(story, block, assets),
+                args.resolution, plan.fps)
 
-        if video_direction is not None:
-            video_id = video_direction["data"]["id"]
-            video_metadata = story["metadata"][video_id]
-            video_key = video_metadata["key"]
-            video_file = "{}/{}.mp4".format(asset_workspace, block["id"])
-            video_file_pre = "{}/pre-{}.mp4".format(
-                asset_workspace, block["id"])
-            download_storage_object("assets", video_key, video_file_pre)
-            subprocess.run([
-                'ffmpeg',
-                '-i', video_file_pre,
-                '-filter:v', 'fps=30',
-                '-vcodec', 'libx264',
-                '-acodec', 'aac',
-                '-y',
-                '{}'.format(video_file)
-            ])
-
-            if video_id == 'walkthrough':
-                speech_file = "{}/{}".format(asset_workspace, block['id'])
-                download_storage_object(
-                    'assets', block['speech']['asset']['key'], speech_file)
-
-                # add to sequence
-                audio_frame_end = layout.add_audio("{}.speech".format(
-                    block['id']), speech_file, sequence_scene, current_frame, library_path)
-
-                audio_duration = audio_frame_end - current_frame
-                new_current_frame = audio_frame_end
-            else:
-                frame_offset = 0
-
-                for segment in video_direction["data"]["segments"]:
-                    segment_data = story["metadata"][video_id]["transcription"][segment]
-                    sequence_name = "{}.{}.audio".format(block["id"], segment)
-                    sequence_scene.sequence_editor.sequences.new_sound(
-                        name=sequence_name, filepath=video_file, channel=3, frame_start=current_frame + frame_offset)
-                    video_sequence = sequence_scene.sequence_editor.sequences_all[sequence_name]
-                    trim_start = int(
-                        segment_data["start"] * sequence_scene.render.fps)
-                    trim_end = int(
-                        segment_data["end"] * sequence_scene.render.fps)
-                    video_sequence.frame_offset_start = trim_start
-                    video_sequence.frame_final_duration = trim_end - trim_start
-                    video_sequence.frame_start = current_frame + frame_offset - trim_start
-
-                    frame_offset += trim_end - trim_start
-
-                audio_duration = frame_offset
-                new_current_frame = current_frame + frame_offset
-
-            video_duration = 0
-
-            for segment in video_direction["data"]["segments"]:
-                segment_data = story["metadata"][video_id]["transcription"][segment]
-                trim_start = segment_data["start"] * sequence_scene.render.fps
-                trim_end = segment_data["end"] * sequence_scene.render.fps
-                video_duration += trim_end - trim_start
-
-            frame_offset = 0
-
-            for segment in video_direction["data"]["segments"]:
-                segment_data = story["metadata"][video_id]["transcription"][segment]
-                sequence_name = "{}.{}".format(block["id"], segment)
-
-                sequence_scene.sequence_editor.sequences.new_movie(
-                    name=sequence_name, filepath=video_file, channel=4, frame_start=current_frame + frame_offset, fit_method='FILL')
-                video_sequence = sequence_scene.sequence_editor.sequences_all[sequence_name]
-                trim_start = math.floor(
-                    segment_data["start"] * sequence_scene.render.fps)
-                trim_end = math.ceil(
-                    segment_data["end"] * sequence_scene.render.fps)
-                target_duration = math.ceil(((trim_end - trim_start) /
-                                             video_duration) * audio_duration)
-
-                video_sequence.frame_offset_start = trim_start
-                video_sequence.frame_offset_end = video_sequence.frame_duration - trim_end
-                video_sequence.speed_factor = video_sequence.frame_final_duration / target_duration
-
-                video_sequence.frame_start += (current_frame +
-                                               frame_offset) - video_sequence.frame_final_start
-
-                frame_offset += video_sequence.frame_final_duration
-
-            current_frame = new_current_frame
+        build_sequence_strips(block_plan, video_scene,
+                              sequence_scene, assets, transcodes)
 
-        else:
-            if 'speech' not in block:
-                raise Exception("block missing speech")
-
-            # add audio to sequence, get frame start
-            # download speech
-            speech_file = "{}/{}".format(asset_workspace, block['id'])
-            download_storage_object(
-                'assets', block['speech']['asset']['key'], speech_file)
-
-            # add to sequence
-            audio_frame_start = current_frame
-            audio_frame_end = layout.add_audio("{}.speech".format(
-                block['id']), speech_file, sequence_scene, audio_frame_start, library_path)
-            frame_start = 0
-            frame_end = audio_frame_end - audio_frame_start
-
-            video_scene.frame_end = frame_end
-            sequence_scene.sequence_editor.sequences.new_scene(
-                name=block["id"], scene=video_scene, channel=4, frame_start=current_frame)
-
-            current_frame = audio_frame_end
-
-            # create stage, animate in camera
-
-            stage = layout.add_stage(block['id'], video_scene, (0, bi*30, 0))
-
-            bpy.context.evaluated_depsgraph_get().update()
-
-            camera = stage["camera"]
-            scene_camera.matrix_world = camera.matrix_world
-            scene_camera.keyframe_insert("location", frame=frame_start)
-            scene_camera.keyframe_insert(
-                "rotation_euler", frame=frame_start)
-            scene_camera.keyframe_insert(
-                "location", frame=frame_end-buffer_frames)
-            scene_camera.keyframe_insert(
-                "rotation_euler", frame=frame_end-buffer_frames)
-
-            standard_duration = 60  # frames
-            fps = video_scene.render.fps
-
-            tags = block['speech']['tags']
-            # a list of dicts with each direction, and it's corresponding tag (or None)
-            tagged_directions = []
-            for i, direction in enumerate(directions):
-                tag = tags.get(str(i))
-                tagged_directions.append({
-                    'direction': direction,
-                    'tag': tag
-                })
-
-            # sort tagged directions by tag time offset
-            tagged_directions = sorted(
-                tagged_directions, key=lambda x: x['tag']['timeOffset'] if x['tag'] else 0)
-
-            # place assets with timings
-            for i in range(len(tagged_directions)):
-                direction = tagged_directions[i]['direction']
-                tag = tagged_directions[i]['tag']
-
-                if tag:
-                    duration = standard_duration
-
-                    tag_frame_start = frame_start + \
-                        int((tag['timeOffset']) * fps)
-
-                    # if there is a next tag, bridge the gap
-                    if i < len(tagged_directions) - 1:
-                        next_direction = tagged_directions[i+1]['direction']
-
-                        if 'asset' in next_direction or next_direction['type'] == 'text':
-                            next_tag = tagged_directions[i+1]['tag']
-                            if next_tag:
-                                next_tag_frame_start = frame_start + \
-                                    int((next_tag['timeOffset']) * fps)
-                                if next_tag_frame_start - tag_frame_start > 60:
-                                    duration = next_tag_frame_start - tag_frame_start
-                    else:
-                        # make the asset last until the end of the speech
-                        duration = frame_end - tag_frame_start
-
-                    if direction['type'] in ('image', 'screenshot') and 'asset' in direction:
-                        asset = direction['asset']
-                        asset_file = "{}/{}_{}".format(asset_workspace,
-                                                       block['id'], i)
-                        download_storage_object(
-                            'assets', asset['key'], asset_file)
-                        layout.add_image(
-                            library_path, asset_file, video_scene, stage, direction.get('location', 'center'), tag_frame_start, tag_frame_start + duration)
-                    elif direction['type'] == 'text':
-                        layout.add_text(library_path, direction['data'], video_scene, stage,
-                                        next_text_position(), tag_frame_start, tag_frame_start + duration, text_material)
-                elif direction['location'] == 'background':
-                    if direction['type'] in ('image', 'screenshot') and 'asset' in direction:
-                        asset = direction['asset']
-                        asset_file = "{}/{}_{}".format(asset_workspace,
-                                                       block['id'], i)
-                        download_storage_object(
-                            'assets', asset['key'], asset_file)
-                        layout.add_image(
-                            library_path, asset_file, video_scene, stage, direction.get('location', 'center'), None, None)
-                    elif direction['type'] == 'text':
-                        layout.add_text(
-                            library_path, direction['data'], video_scene, stage, next_text_position(), None, None, text_material)
-
-    sequence_scene.frame_end = current_frame
+        # appended blocks were timed by their worker
+        tracing.record('append_scene' if block_plan.index in builds else 'build_scene',
+                       block_started, block=block['id'])
+
+    sequence_scene.frame_end = plan.frame_end
     # add music
     sequence_scene.sequence_editor.sequences.new_sound(
         name="music", filepath=os.path.join(library_path, "music.mp3"), channel=1, frame_start=1)
@@ -368,5 +305,13 @@ if '__main__' == __name__:
     music.volume = 0.2
 
     print('done generating scene')
+    print('templates: {}'.format(templates.stats))
+
+    if args.blend_output:
+        with tracing.span('save_blend'):
+            packing.prepare_images(args.pack_policy, args.blend_output)
+            bpy.ops.wm.save_mainfile(filepath=args.blend_output)
 
-    bpy.ops.wm.save_mainfile(filepath=args.blend_output)
+    if args.output:
+        render.render_story(args.output, render.video_scenes(
+            args.profile), profile=args.profile)
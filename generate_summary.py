@@ -6,9 +6,8 @@ import os
 import math
 import json
 import subprocess
-import requests
 import sentry_sdk
-from weaver_blender import layout
+from weaver_blender import layout, packing, prefetch, profiles, render, render_cache, storage, templates, timeline, tracing
 
 
 if os.environ.get('ENV') == 'production':
@@ -22,39 +21,10 @@ if os.environ.get('ENV') == 'production':
     )
 
 
-supabase_url = os.environ["SUPABASE_URL"]
-service_role_key = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 asset_workspace = os.environ.get('ASSET_WORKSPACE', '/tmp')
 library_path = os.path.join(os.path.dirname(__file__), 'library')
 
 
-def download_storage_object(bucket, storage_key, output_path):
-    res = requests.post(
-        "{}/storage/v1/object/sign/{}/{}".format(
-            supabase_url, bucket, storage_key),
-        headers={
-            'Authorization': 'Bearer {}'.format(service_role_key),
-            'Content-Type': 'application/json',
-        },
-        json={
-            "expiresIn": 120,
-        }
-    )
-
-    if res.status_code != 200:
-        print(res.text)
-        raise Exception("error getting signed url")
-
-    res_data = res.json()
-    image_url = res_data['signedURL']
-
-    fileRes = requests.get(
-        "{}/storage/v1/{}".format(supabase_url, image_url))
-
-    with open(output_path, "wb") as f:
-        f.write(fileRes.content)
-
-
 current_text_position = 'top'
 
 
@@ -77,17 +47,33 @@ if '__main__' == __name__:
                         help='path to library')
     parser.add_argument('--story', type=str, required=True,
                         help='path to story descriptor JSON')
-    parser.add_argument('--output', type=str, required=True,
-                        help='output path', default='/tmp/output.blend')
+    parser.add_argument('--output', type=str, required=False,
+                        help='.blend output path, only written when given')
+    parser.add_argument('--pack_policy', type=str, required=False, choices=packing.PACK_POLICIES,
+                        help='how images are stored in the .blend', default='packed')
+    parser.add_argument('--render_output', type=str, required=False,
+                        help='render the story to this path in the same process')
+    parser.add_argument('--audio_output', type=str, required=False,
+                        help='mix the story\'s audio down to this path')
+    parser.add_argument('--profile', type=str, required=False, choices=profiles.PROFILES.keys(),
+                        help='render quality profile', default=profiles.DEFAULT_PROFILE)
     parser.add_argument('--resolution', type=str, required=False,
                         help='output path', default='1920x1080')
 
     args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
 
+    tracing.begin('generate_summary')
+
     with open(args.story, 'r') as f:
         story = json.load(f)
 
-    bpy.ops.preferences.addon_enable(module='io_import_images_as_planes')
+    assets = prefetch.prefetch_story_assets(
+        story, asset_workspace, storage.download_storage_object, sign=storage.sign_storage_objects)
+
+    # every frame range up front, from the story and its speech durations;
+    # also what the handler shards the render by
+    plan = timeline.load_or_plan(
+        args.story, story, lambda key: prefetch.wait_for_asset(assets, key), planner=timeline.plan_summary)
 
     res_x, res_y = [int(x) for x in args.resolution.split('x')]
 
@@ -95,18 +81,18 @@ if '__main__' == __name__:
     sequence_scene.sequence_editor_create()
 
     sequence_scene.view_settings.view_transform = 'Standard'
-    sequence_scene.render.fps = 30
+    sequence_scene.render.fps = plan.fps
     sequence_scene.render.resolution_x = res_x
     sequence_scene.render.resolution_y = res_y
     sequence_scene.render.sequencer_gl_preview = 'MATERIAL'
 
-    current_frame = 1
+    for block, block_plan in zip(story['blocks'], plan.blocks):
+        block_started = tracing.now()
 
-    for bi, block in enumerate(story['blocks']):
-        video_scene = bpy.data.scenes.new('Video')
+        video_scene = bpy.data.scenes.new(block_plan.scene_name)
 
         video_scene.view_settings.view_transform = 'Standard'
-        video_scene.render.fps = 30
+        video_scene.render.fps = plan.fps
         video_scene.render.resolution_x = res_x
         video_scene.render.resolution_y = res_y
         video_scene.render.sequencer_gl_preview = 'MATERIAL'
@@ -144,82 +130,70 @@ if '__main__' == __name__:
             world_emission.outputs[0], world_output.inputs[0])
         video_scene.world = world
 
-        text_material = bpy.data.materials.new("TextMaterial")
-        text_material.use_nodes = True
-        text_material.node_tree.nodes.clear()
-        text_emission = text_material.node_tree.nodes.new("ShaderNodeEmission")
-        text_emission.inputs[0].default_value = text_color
-        text_output = text_material.node_tree.nodes.new(
-            "ShaderNodeOutputMaterial")
-        text_material.node_tree.links.new(
-            text_emission.outputs[0], text_output.inputs[0])
+        text_material = templates.emission_material(text_color)
 
         print('generating scene')
 
-        buffer_frames = 30
+        # the speech and this scene, where the timeline put them
+        speech_strip, scene_strip = block_plan.strips
+        speech_file = prefetch.wait_for_asset(assets, speech_strip.key)
 
-        if 'speech' not in block:
-            raise Exception("block missing speech")
+        audio_frame_end = layout.add_audio(
+            speech_strip.name, speech_file, sequence_scene, speech_strip.frame_start, library_path)
+        if audio_frame_end != speech_strip.frame_end:
+            print('{} is {} frames, planned {}'.format(
+                speech_strip.name, audio_frame_end - speech_strip.frame_start, speech_strip.frames))
 
-        # add audio to sequence, get frame start
-        # download speech
-        speech_file = "{}/{}".format(asset_workspace, block['id'])
-        download_storage_object(
-            'assets', block['speech']['asset']['key'], speech_file)
-
-        # add to sequence
-        audio_frame_start = current_frame
-        audio_frame_end = layout.add_audio("{}.speech".format(
-            block['id']), speech_file, sequence_scene, audio_frame_start, library_path)
-        frame_start = 0
-        frame_end = audio_frame_end - audio_frame_start
-
-        video_scene.frame_end = frame_end
+        video_scene.frame_end = block_plan.scene_frame_end
         sequence_scene.sequence_editor.sequences.new_scene(
-            name=block["id"], scene=video_scene, channel=4, frame_start=current_frame)
-
-        current_frame = audio_frame_end
+            name=scene_strip.name, scene=video_scene, channel=scene_strip.channel, frame_start=scene_strip.frame_start)
 
         # create stage, animate in camera
 
-        stage = layout.add_stage(block['id'], video_scene, (0, bi*30, 0))
+        stage = layout.add_stage(block['id'], video_scene, block_plan.stage_location)
 
         bpy.context.evaluated_depsgraph_get().update()
 
         camera = stage["camera"]
         scene_camera.matrix_world = camera.matrix_world
-        scene_camera.keyframe_insert("location", frame=frame_start)
-        scene_camera.keyframe_insert(
-            "rotation_euler", frame=frame_start)
-        scene_camera.keyframe_insert(
-            "location", frame=frame_end-buffer_frames)
-        scene_camera.keyframe_insert(
-            "rotation_euler", frame=frame_end-buffer_frames)
+        for frame in block_plan.camera_frames:
+            scene_camera.keyframe_insert("location", frame=frame)
+            scene_camera.keyframe_insert("rotation_euler", frame=frame)
 
-        standard_duration = 60  # frames
-        fps = video_scene.render.fps
+        block_asset = None
+        # the version of every asset the block uses, a re-uploaded asset
+        # renders differently under the same key
+        asset_versions = [storage.downloaded_etag(speech_file)]
 
         if block['type'] in ('image', 'screenshot'):
             if block['type'] == 'image':
-                asset = story['assets'][block['arguments']['image_id']]
+                block_asset = story['assets'][block['arguments']['image_id']]
             else:
-                asset = story['assets'][block['arguments']['url_id']]
-
-            if 'storage' in asset:
-                asset_file = "{}/{}_{}".format(asset_workspace,
-                                               block['id'], asset['id'])
-                download_storage_object(
-                    'assets', asset['storage']['key'], asset_file)
-                layout.add_image(
-                    library_path, asset_file, video_scene, stage, 'background', frame_start, frame_end)
+                block_asset = story['assets'][block['arguments']['url_id']]
+
+            if 'storage' not in block_asset:
+                print('missing asset {}'.format(block_asset['id']))
+
+        for placement in block_plan.placements:
+            if placement.kind == 'image':
+                asset_file = prefetch.wait_for_asset(assets, placement.key)
+                asset_versions.append(storage.downloaded_etag(asset_file))
+                layout.add_image(library_path, asset_file, video_scene, stage, placement.location,
+                                 placement.frame_start, placement.frame_end, placement.key)
             else:
-                print('missing asset {}'.format(asset['id']))
+                layout.add_text(library_path, placement.text, video_scene, stage, placement.location,
+                                placement.frame_start, placement.frame_end, text_material)
+
+        # everything that affects how this block renders, see render_cache;
+        # assets without a version can't be told apart, always render those
+        if None not in asset_versions:
+            video_scene['content_hash'] = render_cache.content_hash(
+                'summary', block, block_asset, asset_versions, story['metadata']['title'],
+                story['metadata'].get('colors'), args.resolution)
 
-        if story['metadata']['title']:
-            layout.add_text(library_path, story['metadata']['title'],
-                            video_scene, stage, 'bottom', None, None, text_material)
+        tracing.record('build_scene', block_started, block=block['id'])
 
-    sequence_scene.frame_end = current_frame
+    sequence_scene.frame_end = plan.frame_end
     # add music
     # sequence_scene.sequence_editor.sequences.new_sound(
     #     name="music", filepath=os.path.join(library_path, "music.mp3"), channel=1, frame_start=1)
@@ -227,5 +201,16 @@ if '__main__' == __name__:
     # music.volume = 0.2
 
     print('done generating scene')
+    print('templates: {}'.format(templates.stats))
+
+    if args.output:
+        with tracing.span('save_blend'):
+            packing.prepare_images(args.pack_policy, args.output)
+            bpy.ops.wm.save_mainfile(filepath=args.output)
+
+    if args.audio_output:
+        render.mixdown(args.audio_output)
 
-    bpy.ops.wm.save_mainfile(filepath=args.output)
+    if args.render_output:
+        render.render_story(args.render_output, render.video_scenes(
+            args.profile), profile=args.profile)
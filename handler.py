@@ -1,9 +1,16 @@
 import os
 import sys
+import json
+import shutil
+import asyncio
+import tempfile
 import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import runpod
-import requests
 import sentry_sdk
+from weaver_blender import cache, distributed, encode, profiles, render_cache, storage, timeline, tracing
+from weaver_blender.worker import BlenderWorker
 
 
 if os.environ.get('ENV') == 'production':
@@ -18,143 +25,264 @@ if os.environ.get('ENV') == 'production':
 
 BLENDER_BIN = "/bin/blender" if sys.platform == "linux" else "/Applications/Blender.app/Contents/MacOS/Blender"
 
-supabase_url = os.environ["SUPABASE_URL"]
-service_role_key = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
 asset_workspace = os.environ.get('ASSET_WORKSPACE', '/tmp')
 
+STITCH_DOWNLOAD_WORKERS = int(os.environ.get('STITCH_DOWNLOAD_WORKERS', 8))
+# jobs a worker takes at once; blender work is still one job at a time in the
+# warm worker, the others download, encode and upload meanwhile
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 2))
 
-def download_storage_object(bucket, storage_key, output_path):
-    res = requests.post(
-        "{}/storage/v1/object/sign/{}/{}".format(
-            supabase_url, bucket, storage_key),
-        headers={
-            'Authorization': 'Bearer {}'.format(service_role_key),
-            'Content-Type': 'application/json',
-        },
-        json={
-            "expiresIn": 120,
-        }
-    )
+job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+
+blender_worker = None
+
+if os.environ.get('BLENDER_WARM_WORKER', '1') == '1':
+    # keep blender loaded between jobs instead of paying startup per stage
+    blender_worker = BlenderWorker(
+        BLENDER_BIN, "{}/blender-worker.sock".format(asset_workspace),
+        max_jobs=int(os.environ.get('BLENDER_WORKER_MAX_JOBS', 50)),
+        max_memory=int(os.environ.get('BLENDER_WORKER_MAX_MEMORY', 8 * 1024 ** 3)))
+    blender_worker.start()
+
+
+@contextmanager
+def job_workspace():
+    # everything a job writes goes in its own directory, removed afterwards;
+    # caches stay shared under asset_workspace
+    workspace = tempfile.mkdtemp(prefix='job-', dir=asset_workspace)
+
+    try:
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def job_environ(workspace):
+    return dict(tracing.environ(), ASSET_WORKSPACE=workspace,
+                ASSET_CACHE_DIR=cache.default_cache().root,
+                RENDER_CACHE_DIR=render_cache.render_cache().root,
+                **{cache.JOB_STATS_ENV: cache.job_stats_file()})
+
+
+def run_blender(script, args, workspace, blend=None):
+    if blender_worker is not None:
+        blender_worker.run(script, args, blend=blend,
+                           env=job_environ(workspace))
+        return
+
+    proc = subprocess.run([BLENDER_BIN, "--background"] + ([blend] if blend else []) + ["--python-exit-code", "1",
+                                                                                      "--python", script, "--"] + args,
+                          env=dict(os.environ, **job_environ(workspace)))
+
+    if proc.returncode != 0:
+        raise Exception("{} exited with {}".format(script, proc.returncode))
+
+
+def shard_queue(input):
+    if input.get("queue") == "local" or os.environ.get('SHARD_QUEUE') == 'local':
+        return distributed.LocalQueue(handle)
+
+    return distributed.RunpodQueue(os.environ["RUNPOD_SHARD_ENDPOINT"])
+
+
+def render_distributed(input, workspace):
+    id = input["id"]
+    user_id = input["user_id"]
+    profile = input.get("profile", profiles.DEFAULT_PROFILE)
+    blend = "{}/output.blend".format(workspace)
+
+    # shards run on other machines, so the .blend has to carry its images;
+    # the audio is mixed now, for the final mux
+    run_blender("generate_summary.py", ["--library", "{}.blend".format('common'),
+                                        "--story", "{}/story.json".format(workspace), "--resolution", "1080x1920",
+                                        "--output", blend, "--pack_policy", "packed",
+                                        "--audio_output", "{}/output.mp3".format(workspace)], workspace)
+
+    blend_storage_key = "{}/{}.blend".format(user_id, id)
+    storage.upload_storage_object("blend-assets", blend_storage_key,
+                                  blend, "application/blender", upsert=True)
+
+    # the render jobs come from the timeline generate_summary.py planned,
+    # chunked the same way the shards' render processes chunk their scenes
+    jobs = timeline.load("{}/story.json".format(workspace)).render_jobs()
+
+    with tracing.span('plan_shards'):
+        shards = distributed.plan_shards(jobs)
+    print("rendering {} in {} shards".format(id, len(shards)))
+
+    with tracing.span('render_shards', shards=len(shards)):
+        results = distributed.run_shards(shard_queue(input), shards, lambda shard: {
+            "shard": shard,
+            "blend": blend_storage_key,
+            "id": id,
+            "user_id": user_id,
+            "profile": profile,
+            "trace_id": tracing.environ().get(tracing.TRACE_ID_ENV),
+        })
+
+    clips = ["{}/shard-{}.mp4".format(workspace, shard['index'])
+             for shard in shards]
+
+    storage.sign_storage_objects(
+        "assets", [results[shard['index']]["result"] for shard in shards])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        downloads = [tracing.submit(executor, storage.download_storage_object, "assets", results[shard['index']]["result"], clip)
+                     for shard, clip in zip(shards, clips)]
+
+        for download in downloads:
+            download.result()
+
+    encode.concat_and_mux(clips, "{}/output.mp3".format(workspace),
+                          "{}/output.mp4".format(workspace))
 
-    if res.status_code != 200:
-        print(res.text)
-        raise Exception("error getting signed url")
-
-    res_data = res.json()
-    image_url = res_data['signedURL']
-
-    fileRes = requests.get(
-        "{}/storage/v1/{}".format(supabase_url, image_url))
-
-    with open(output_path, "wb") as f:
-        f.write(fileRes.content)
-
-
-def upload_storage_object(bucket, storage_key, filepath, content_type, upsert=False):
-    with open(filepath, "rb") as output_blend:
-        with requests.post(
-            "{}/storage/v1/object/{}/{}".format(
-                supabase_url,
-                bucket,
-                storage_key
-            ),
-            headers={
-                'Authorization': 'Bearer {}'.format(service_role_key),
-                'Content-Type': content_type,
-                'X-Upsert': str(upsert).lower(),
-            },
-            data=output_blend.read()
-        ) as response:
-            if not response.ok:
-                print("error uploading asset")
-                print(response.text)
-                raise Exception(
-                    "error uploading asset: {}".format(response.text))
-
-
-def handler(event):
+
+def render_shard(input, workspace):
+    shard = input["shard"]
+    name = "{}-{}".format(input["id"], shard['index'])
+
+    blend = "{}/shard-{}.blend".format(workspace, name)
+    storage.download_storage_object("blend-assets", input["blend"], blend)
+
+    with open("{}/shard-{}.json".format(workspace, name), 'w') as f:
+        json.dump(shard, f)
+
+    run_blender("render_story.py", ["--shard", "{}/shard-{}.json".format(workspace, name),
+                                    "--output", "{}/shard-{}.mp4".format(workspace, name),
+                                    "--profile", input.get("profile", profiles.DEFAULT_PROFILE)],
+                workspace, blend=blend)
+
+    storage_key = "{}/shards/{}/{}.mp4".format(
+        input["user_id"], input["id"], shard['index'])
+
+    storage.upload_storage_object("assets", storage_key,
+                                  "{}/shard-{}.mp4".format(workspace, name), "video/mp4", upsert=True)
+
+    return {"result": storage_key}
+
+
+def handle(event):
     input = event["input"]
 
-    if 'story' in input:
+    with job_workspace() as workspace:
+        with cache.job_stats("{}/cache-stats.jsonl".format(workspace)) as job_cache_stats:
+            with tracing.trace("job", workspace, input.get("trace_id")) as job_trace:
+                result = run_job(input, workspace)
+
+            # this job's hits, misses and bytes, from every process it ran
+            result["cache"] = job_cache_stats(cache.default_cache().root)
+
+        if job_trace is not None:
+            result["timing"] = tracing.report(job_trace)
+
+            if "profile" in result:
+                # rendering only, from the blender process or the shards
+                totals = result["timing"]["totals"]
+                result["render_seconds"] = round(
+                    totals.get("render", 0) + totals.get("render_shards", 0), 3)
+                print("rendered with the {} profile in {:.1f}s".format(
+                    result["profile"], result["render_seconds"]))
+
+    return result
+
+
+async def handler(event):
+    # jobs block on blender, ffmpeg and storage, run them off the event loop
+    # so the worker can pick up the next one
+    return await asyncio.get_running_loop().run_in_executor(job_executor, handle, event)
+
+
+def concurrency_modifier(current_concurrency):
+    return MAX_CONCURRENCY
+
+
+def run_job(input, workspace):
+    if 'shard' in input:
+        return render_shard(input, workspace)
+    elif 'story' in input:
         story = input["story"]
         id = input["id"]
         user_id = input["user_id"]
+        profile = input.get("profile", profiles.DEFAULT_PROFILE)
+        profiles.get_profile(profile)
 
-        with open('./story.json', 'w') as f:
+        with open("{}/story.json".format(workspace), 'w') as f:
             f.write(story)
 
-        blend_proc = subprocess.run([BLENDER_BIN, "--background", "--python-exit-code", "1",
-                                    "--python", "generate_summary.py", "--", "--library", "{}.blend".format(
-                                        'common'),
-                                     "--story", './story.json', "--resolution", "1080x1920", "--output", "{}/output.blend".format(asset_workspace)])
-
-        if blend_proc.returncode != 0:
-            print("error generating {}".format(id))
-            raise Exception("error generating {}".format(id))
+        generate_args = ["--library", "{}.blend".format('common'),
+                         "--story", "{}/story.json".format(workspace), "--resolution", "1080x1920",
+                         "--render_output", "{}/output.mp4".format(workspace),
+                         "--profile", profile]
+
+        if input.get("save_blend") or os.environ.get('SAVE_BLEND') == '1':
+            # debug artifact only, scenes are rendered in the same process
+            generate_args += ["--output",
+                              "{}/output.blend".format(workspace)]
+
+        try:
+            if input.get("distributed") or os.environ.get('DISTRIBUTED_RENDER') == '1':
+                render_distributed(input, workspace)
+            else:
+                run_blender("generate_summary.py", generate_args, workspace)
+        except Exception as e:
+            print("error rendering {}: {}".format(id, e))
+            raise Exception("error rendering {}".format(id))
 
         # blend_storage_key = "{}/{}.blend".format(user_id, id)
 
         # upload_storage_object("blend-assets", blend_storage_key,
-        #                       "{}/output.blend".format(asset_workspace), "application/blender", upsert=True)
-
-        render_proc = subprocess.run([BLENDER_BIN, "--background", "{}/output.blend".format(asset_workspace), "--python-exit-code", "1",
-                                      "--python", "render_story.py", "--",
-                                      "--output", "{}/output.mp4".format(asset_workspace), "--preview"])
-
-        if render_proc.returncode != 0:
-            print("error rendering {}".format(id))
-            raise Exception("error rendering {}".format(id))
+        #                       "{}/output.blend".format(workspace), "application/blender", upsert=True)
 
         storage_key = "{}/{}.mp4".format(user_id, id)
 
-        upload_storage_object("assets", storage_key,
-                              "{}/output.mp4".format(asset_workspace), "video/mp4", upsert=True)
+        storage.upload_storage_object("assets", storage_key,
+                                      "{}/output.mp4".format(workspace), "video/mp4", upsert=True)
 
-        return {"result": storage_key}
+        return {"result": storage_key, "profile": profile}
     else:
         # final video render
         contents = input["contents"]
 
-        videos = []
-
-        for content in contents:
-            download_storage_object(
-                "assets", content["video"], "{}/{}.mp4".format(asset_workspace, content["id"]))
-            videos.append("{}/{}.mp4".format(asset_workspace, content["id"]))
+        videos = ["{}/{}.mp4".format(workspace, content["id"])
+                  for content in contents]
 
-        # write ffmpeg concat file list to videos.txt
-        with open("{}/videos.txt".format(asset_workspace), "w") as f:
-            for video in videos:
-                f.write("file '{}'\n".format(video))
+        storage.sign_storage_objects(
+            "assets", [content["video"] for content in contents])
 
-        # combine videos with ffmpeg, using concat demuxer
-        ffmpeg_proc = subprocess.run(["ffmpeg", "-f", "concat", "-safe", "0", "-i", "{}/videos.txt".format(
-            asset_workspace), "-c", "copy", "{}/output.mp4".format(asset_workspace)])
+        with ThreadPoolExecutor(max_workers=STITCH_DOWNLOAD_WORKERS) as executor:
+            downloads = [tracing.submit(executor, storage.download_storage_object, "assets", content["video"], video)
+                         for content, video in zip(contents, videos)]
 
-        if ffmpeg_proc.returncode != 0:
-            print("error combining videos")
-            raise Exception("error combining videos")
+            # the thumbnail only needs the first clip
+            screenshot = tracing.submit(executor,
+                                        lambda: encode.first_frame(downloads[0].result(), "{}/output.png".format(workspace)))
 
-        # get first frame of video as png using ffmpeg
-        ffmpeg_proc = subprocess.run(["ffmpeg", "-i", "{}/output.mp4".format(
-            asset_workspace), "-vframes", "1", "-q:v", "2", "{}/output.png".format(asset_workspace)])
+            # concat picks up each clip as soon as it and everything before
+            # it has landed
+            encode.stream_concat((download.result() for download in downloads),
+                                 "{}/output.mp4".format(workspace))
 
-        if ffmpeg_proc.returncode != 0:
-            print("error getting first frame")
-            raise Exception("error getting first frame")
+            screenshot.result()
 
         storage_key = "{}/stories/{}.mp4".format(input["user_id"], input["id"])
         screenshot_storage_key = "{}/stories/{}.png".format(
             input["user_id"], input["id"])
 
-        upload_storage_object("assets", storage_key,
-                              "{}/output.mp4".format(asset_workspace), "video/mp4", upsert=True)
-        upload_storage_object("assets", screenshot_storage_key,
-                              "{}/output.png".format(asset_workspace), "image/png", upsert=True)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            uploads = [
+                tracing.submit(executor, storage.upload_storage_object, "assets", storage_key,
+                               "{}/output.mp4".format(workspace), "video/mp4", upsert=True),
+                tracing.submit(executor, storage.upload_storage_object, "assets", screenshot_storage_key,
+                               "{}/output.png".format(workspace), "image/png", upsert=True),
+            ]
+
+            for upload in uploads:
+                upload.result()
 
         return {"result": storage_key, "screenshot": screenshot_storage_key}
 
 
 runpod.serverless.start({
-    "handler": handler
+    "handler": handler,
+    "concurrency_modifier": concurrency_modifier,
 })
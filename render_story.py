@@ -1,9 +1,9 @@
-import bpy
 import sys
 import argparse
-import subprocess
 import os
+import json
 import sentry_sdk
+from weaver_blender import composite, eevee, packing, profiles, render, tracing
 
 
 if os.environ.get('ENV') == 'production':
@@ -19,75 +19,84 @@ if os.environ.get('ENV') == 'production':
 
 if '__main__' == __name__:
     parser = argparse.ArgumentParser()
-    parser.add_argument('--output', type=str, required=True,
+    parser.add_argument('--output', type=str, required=False,
                         help='output path', default='/tmp/blender-out')
-    parser.add_argument('--preview', action='store_true', default=False)
+    parser.add_argument('--preview', action='store_true', default=False,
+                        help='shorthand for --profile preview')
+    parser.add_argument('--profile', type=str, required=False, choices=profiles.PROFILES.keys(),
+                        help='render quality profile', default=profiles.DEFAULT_PROFILE)
+    parser.add_argument('--workers', type=int, required=False,
+                        help='number of blender render processes, defaults to what the machine can fit')
+    parser.add_argument('--plan', type=str, required=False,
+                        help='render plan to execute as a worker')
+    parser.add_argument('--worker', type=int, required=False,
+                        help='index of the worker in the render plan')
+    parser.add_argument('--pipe', action='store_true', default=None,
+                        help='render frames straight into one ffmpeg encoder instead of per-scene videos')
+    parser.add_argument('--shard', type=str, required=False,
+                        help='render only the jobs in this shard descriptor, video only')
+    parser.add_argument('--backend', type=str, required=False, choices=render.BACKENDS,
+                        help='eevee, or composite to draw flat scenes without eevee, defaults to RENDER_BACKEND')
+    parser.add_argument('--parity', action='store_true', default=False,
+                        help='compare composited frames against eevee, report to <output>.parity.json and exit')
+    parser.add_argument('--calibrate', action='store_true', default=False,
+                        help='find the eevee samples flat scenes need with this profile and resolution, record them and exit')
 
     args = parser.parse_args(sys.argv[sys.argv.index('--') + 1:])
 
-    scenes = []
+    tracing.begin('render_story')
 
-    sequence_scene = bpy.data.scenes['Sequence']
+    if args.preview:
+        args.profile = 'preview'
 
-    for scene in bpy.data.scenes:
-        if 'Video' in scene.name:
-            scene.render.filepath = "/tmp/{}.mp4".format(scene.name)
-            scene.render.image_settings.file_format = 'FFMPEG'
-            scene.render.ffmpeg.format = 'MPEG4'  # Matroska?
-            scene.render.ffmpeg.audio_codec = 'NONE'
-            scene.eevee.taa_render_samples = 32
+    packing.resolve_images(os.environ.get('ASSET_WORKSPACE', '/tmp'))
 
-            scenes.append(scene)
+    if args.plan:
+        # worker process, render our share of the plan and exit
+        render.run_render_worker(args.plan, args.worker)
+        sys.exit(0)
 
-    # if args.preview:
-    #     video_scene = bpy.data.scenes['Video']
-    #     video_scene.render.resolution_percentage = 50
-    #     video_scene.eevee.taa_render_samples = 16
+    scenes = render.video_scenes(args.profile)
 
-    bpy.context.window.scene = sequence_scene
-    sequence_scene.render.ffmpeg.audio_codec = 'AAC'
-    bpy.ops.sound.mixdown(filepath="{}.mp3".format(
-        args.output))
-
-    for video_scene in scenes:
-        bpy.context.window.scene = video_scene
-        bpy.ops.render.render(animation=True, scene=video_scene.name)
-
-    # write concat file list to txt
-    with open('{}.txt'.format(args.output), 'w') as f:
+    if args.parity:
+        report = []
         for scene in scenes:
-            f.write("file {}\n".format(scene.render.filepath))
-
-    # combine videos
-    subprocess.run([
-        'ffmpeg',
-        '-f', 'concat',
-        '-safe', '0',
-        '-i', '{}.txt'.format(args.output),
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-y',
-        '{}.videos.mp4'.format(args.output)
-    ])
-
-    # combine audio and video
-    subprocess.run([
-        'ffmpeg',
-        '-i', '{}.videos.mp4'.format(args.output),
-        '-i', '{}.mp3'.format(args.output),
-        '-c:v', 'copy',
-        '-c:a', 'aac',
-        '-y',
-        '{}'.format(args.output)
-    ])
-
-    print('render complete, cleaning up')
-
-    os.remove('{}.mp3'.format(args.output))
-    os.remove('{}.txt'.format(args.output))
-    os.remove('{}.videos.mp4'.format(args.output))
-
-    for scene in scenes:
-        os.remove(scene.render.filepath)
-
-    print('done')
+            reason = composite.incompatible(scene)
+            if reason is not None:
+                print('skipping {}, {}'.format(scene.name, reason))
+                continue
+
+            report += composite.parity(scene, args.output)
+
+        with open('{}.parity.json'.format(args.output), 'w') as f:
+            json.dump(report, f, indent=2)
+
+        failed = [frame for frame in report if not frame['ok']]
+        for frame in failed:
+            print('{} frame {} differs on {:.2%} of pixels'.format(
+                frame['scene'], frame['frame'], frame['differing_pixels']))
+
+        sys.exit(1 if failed else 0)
+
+    if args.calibrate:
+        # not part of a job, run once per blender version, resolution and
+        # profile, e.g. from the benchmark, and commit the result
+        flat = [scene for scene in scenes if scene['emission_only']]
+        if not flat:
+            print('no flat scenes to calibrate with')
+            sys.exit(1)
+
+        samples = max(eevee.calibrate_samples(scene, args.output) for scene in flat)
+        print('{}: {} samples'.format(eevee.calibration_key(flat[0]),
+                                      eevee.record_calibration(flat[0], samples)))
+        sys.exit(0)
+
+    if args.shard:
+        with open(args.shard, 'r') as f:
+            shard = json.load(f)
+
+        render.render_shard(shard, args.output, workers=args.workers)
+    else:
+        render.render_story(args.output, scenes,
+                            workers=args.workers, pipe=args.pipe, profile=args.profile,
+                            backend=args.backend)
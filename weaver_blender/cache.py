@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import shutil
+import hashlib
+import tempfile
+import contextvars
+from contextlib import contextmanager
+
+
+# set for the length of a job, every process working on it appends its cache
+# counters there so the job can report its own hits and misses
+JOB_STATS_ENV = 'ASSET_CACHE_JOB_STATS'
+
+# the job running in this context in the handler, where jobs run concurrently
+current_job_stats = contextvars.ContextVar('current_job_stats', default=None)
+
+# how often a process adds its counters to the cache's shared stats.json
+STATS_FLUSH_SECONDS = float(os.environ.get('ASSET_CACHE_STATS_FLUSH_SECONDS', 30))
+
+
+class AssetCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes_downloaded': 0,
+            'bytes_served': 0,
+            'download_seconds': 0.0,
+            'evictions': 0,
+        }
+        # counters not yet added to stats.json
+        self.unflushed = {}
+        self.flushed_at = time.monotonic()
+        # output path -> cache entry it was materialized from
+        self.materialized = {}
+
+        for directory in ('objects', 'locks', 'tmp'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+        atexit.register(self.flush_stats)
+
+    def key(self, *parts):
+        # content address for an object, e.g. (bucket, storage key, etag)
+        return hashlib.sha256('\0'.join(str(p) for p in parts if p is not None).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, 'objects', key[:2], key)
+
+    def lock_path(self, name):
+        return os.path.join(self.root, 'locks', '{}.lock'.format(name))
+
+    @contextmanager
+    def lock(self, name, blocking=True):
+        # flock so the handler and the blender subprocesses can share the cache
+        path = self.lock_path(name)
+
+        while True:
+            f = open(path, 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+
+            # evicting an entry removes its lock file, a lock taken on the
+            # removed file doesn't exclude anyone, take the new one instead
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+
+            f.close()
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def fetch(self, key, output_path, produce):
+        # materializes the entry for key at output_path, calling produce(path)
+        # to fill the cache on a miss
+        path = self.entry_path(key)
+        added = 0
+
+        with self.lock(key):
+            if os.path.exists(path):
+                os.utime(path)
+                size = os.path.getsize(path)
+                self.record(hits=1, bytes_served=size)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.join(self.root, 'tmp'))
+                os.close(fd)
+
+                try:
+                    start = time.monotonic()
+                    produce(tmp_path)
+                    elapsed = time.monotonic() - start
+                    # entries are read-only so nothing can write through a
+                    # hardlinked output path into the cache
+                    os.chmod(tmp_path, 0o444)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+                size = os.path.getsize(path)
+                self.record(misses=1, bytes_downloaded=size,
+                            download_seconds=elapsed)
+                added = size
+
+            materialize(path, output_path)
+            self.materialized[os.path.abspath(output_path)] = path
+
+        if added:
+            self.add_size(added)
+
+        return output_path
+
+    def contains(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def temp_path(self):
+        # somewhere to download to that add() can move into the cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        os.close(fd)
+        return tmp_path
+
+    def add(self, key, path, output_path, download_seconds=0.0):
+        # moves a file downloaded to temp_path() in under key and materializes
+        # it at output_path, for keys only known once the download has started
+        entry = self.entry_path(key)
+        added = 0
+
+        with self.lock(key):
+            if os.path.exists(entry):
+                # another process downloaded the same version meanwhile
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                os.chmod(path, 0o444)
+                os.replace(path, entry)
+                added = os.path.getsize(entry)
+
+            self.record(misses=1, bytes_downloaded=os.path.getsize(entry),
+                        download_seconds=download_seconds)
+            materialize(entry, output_path)
+            self.materialized[os.path.abspath(output_path)] = entry
+
+        if added:
+            self.add_size(added)
+
+        return output_path
+
+    def ref(self, name):
+        # refs are small entries holding another entry's key part, e.g. the
+        # last version seen of a storage key, and are evicted like any other
+        try:
+            with open(self.entry_path(name), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set_ref(self, name, value):
+        path = self.entry_path(name)
+
+        with self.lock(name):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = self.temp_path()
+            with open(tmp_path, 'w') as f:
+                f.write(value)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+
+        self.add_size(len(value))
+
+    def get(self, key, output_path):
+        # materializes a cached entry without filling it on a miss
+        path = self.entry_path(key)
+
+        with self.lock(key):
+            if not os.path.exists(path):
+                return False
+
+            os.utime(path)
+            self.record(hits=1, bytes_served=os.path.getsize(path))
+            materialize(path, output_path)
+            self.materialized[os.path.abspath(output_path)] = path
+
+        return True
+
+    def put(self, key, source_path):
+        # adds an existing file, e.g. a rendered clip, under key
+        path = self.entry_path(key)
+
+        with self.lock(key):
+            if os.path.exists(path):
+                return
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+            os.close(fd)
+            shutil.copyfile(source_path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+
+        self.add_size(os.path.getsize(path))
+
+    def size_path(self):
+        return os.path.join(self.root, 'size')
+
+    def add_size(self, size):
+        # keeps a running total of the entries' bytes so adding one doesn't
+        # walk the whole cache, eviction walks it only when over budget
+        with self.lock('index'):
+            try:
+                with open(self.size_path(), 'r') as f:
+                    total = int(f.read()) + size
+            except (FileNotFoundError, ValueError):
+                total = self.scan()[1]
+
+            if total > self.max_bytes:
+                total = self.evict()
+
+            self.write_size(total)
+
+    def write_size(self, total):
+        with open(self.size_path() + '.tmp', 'w') as f:
+            f.write(str(total))
+        os.replace(self.size_path() + '.tmp', self.size_path())
+
+    def scan(self):
+        entries = []
+        total = 0
+
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, 'objects')):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total += stat.st_size
+
+        return entries, total
+
+    def evict(self):
+        # with the index lock held, returns the bytes left; the walk also
+        # corrects any drift in the running total
+        entries, total = self.scan()
+
+        # least recently used first
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            with self.lock(key, blocking=False) as locked:
+                # skip entries another process is reading or writing
+                if not locked:
+                    continue
+
+                os.remove(self.entry_path(key))
+                os.remove(self.lock_path(key))
+                total -= size
+                self.record(evictions=1)
+
+        return total
+
+    def record(self, **deltas):
+        for name, value in deltas.items():
+            self.stats[name] += value
+            self.unflushed[name] = self.unflushed.get(name, 0) + value
+
+        job_stats_path = job_stats_file()
+        if job_stats_path is not None:
+            with open(job_stats_path, 'a') as f:
+                f.write(json.dumps(dict(deltas, root=self.root)) + '\n')
+
+        if time.monotonic() - self.flushed_at >= STATS_FLUSH_SECONDS:
+            self.flush_stats()
+
+    def flush_stats(self):
+        # aggregate counters across every process sharing the cache, batched
+        # so hits don't all queue on one lock
+        self.flushed_at = time.monotonic()
+        if not self.unflushed:
+            return
+
+        deltas, self.unflushed = self.unflushed, {}
+
+        with self.lock('stats'):
+            totals = self.read_stats()
+            for name, value in deltas.items():
+                totals[name] = totals.get(name, 0) + value
+
+            stats_path = os.path.join(self.root, 'stats.json')
+            with open(stats_path + '.tmp', 'w') as f:
+                json.dump(totals, f)
+            os.replace(stats_path + '.tmp', stats_path)
+
+    def read_stats(self):
+        try:
+            with open(os.path.join(self.root, 'stats.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+def job_stats_file():
+    return current_job_stats.get() or os.environ.get(JOB_STATS_ENV)
+
+
+@contextmanager
+def job_stats(path):
+    # yields a function returning the counters recorded so far for caches
+    # under root, from this process and any started with JOB_STATS_ENV=path
+    token = current_job_stats.set(path)
+
+    def read(root):
+        totals = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    deltas = json.loads(line)
+                    if deltas.pop('root') == root:
+                        for name, value in deltas.items():
+                            totals[name] = totals.get(name, 0) + value
+
+        return totals
+
+    try:
+        yield read
+    finally:
+        current_job_stats.reset(token)
+
+
+def materialize(path, output_path):
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    try:
+        os.link(path, output_path)
+    except OSError:
+        # different filesystem
+        shutil.copyfile(path, output_path)
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+
+    if _default_cache is None:
+        _default_cache = AssetCache(
+            os.environ.get('ASSET_CACHE_DIR', os.path.join(
+                os.environ.get('ASSET_WORKSPACE', '/tmp'), 'weaver-cache')),
+            int(os.environ.get('ASSET_CACHE_MAX_BYTES', 10 * 1024 ** 3)))
+
+    return _default_cache
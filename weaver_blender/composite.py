@@ -0,0 +1,328 @@
+import bpy
+import io
+import os
+import numpy
+
+from . import eevee
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    # only needed for the composite backend, eevee renders don't use it
+    Image = None
+
+
+# drawn at this multiple of the output size and box-filtered down, our
+# stand-in for Eevee's anti-aliasing
+SUPERSAMPLE = int(os.environ.get('COMPOSITE_SUPERSAMPLE', 2))
+
+# composited frames may differ from Eevee by this many 8-bit levels on
+# PARITY_PIXELS of the pixels, edges and alpha blending aren't bit-exact
+PARITY_LEVELS = int(os.environ.get('COMPOSITE_PARITY_LEVELS', 8))
+PARITY_PIXELS = float(os.environ.get('COMPOSITE_PARITY_PIXELS', 0.01))
+
+GEOMETRY_TYPES = ('MESH', 'CURVE', 'FONT', 'SURFACE', 'META')
+
+
+def linear_to_srgb(value):
+    value = min(max(value, 0.0), 1.0)
+
+    if value <= 0.0031308:
+        return value * 12.92
+
+    return 1.055 * value ** (1 / 2.4) - 0.055
+
+
+def display_color(color, strength=1.0):
+    return tuple(int(round(linear_to_srgb(c * strength) * 255)) for c in color[:3])
+
+
+def classify_material(material):
+    # ('flat', color) for a plain emission, ('image', image) for an image
+    # plane, None for anything we can't draw
+    if material is None or not material.use_nodes:
+        return None
+
+    nodes = {node.bl_idname: node for node in material.node_tree.nodes}
+
+    if set(nodes) == {'ShaderNodeEmission', 'ShaderNodeOutputMaterial'}:
+        emission = nodes['ShaderNodeEmission']
+        if emission.inputs['Color'].is_linked or emission.inputs['Strength'].is_linked:
+            return None
+
+        return ('flat', display_color(emission.inputs['Color'].default_value,
+                                      emission.inputs['Strength'].default_value))
+
+    if set(nodes) == {'ShaderNodeTexImage', 'ShaderNodeGroup', 'ShaderNodeOutputMaterial'} and \
+            nodes['ShaderNodeGroup'].node_tree is not None and \
+            nodes['ShaderNodeGroup'].node_tree.name.startswith('ImagePlaneShader'):
+        image = nodes['ShaderNodeTexImage'].image
+        if image is None or image.colorspace_settings.name != 'sRGB':
+            return None
+
+        return ('image', image)
+
+    return None
+
+
+def world_color(scene):
+    if scene.world is None or not scene.world.use_nodes:
+        return None
+
+    for node in scene.world.node_tree.nodes:
+        if node.bl_idname in ('ShaderNodeEmission', 'ShaderNodeBackground'):
+            if node.inputs['Color'].is_linked or node.inputs['Strength'].is_linked:
+                return None
+
+            return display_color(node.inputs['Color'].default_value,
+                                 node.inputs['Strength'].default_value)
+
+    return None
+
+
+def object_materials(obj, mesh):
+    materials = []
+
+    for index, slot in enumerate(obj.material_slots):
+        material = slot.material
+        # geometry nodes set materials on the evaluated mesh
+        if material is None and index < len(mesh.materials):
+            material = mesh.materials[index]
+        materials.append(material)
+
+    return materials
+
+
+def incompatible(scene):
+    # why scene can't be composited, or None if it can
+    if Image is None:
+        return "Pillow is not installed"
+    if not scene.get('emission_only'):
+        return "scene isn't emission only"
+    if scene.view_settings.view_transform != 'Standard' or scene.view_settings.look != 'None' or \
+            scene.view_settings.exposure != 0 or scene.view_settings.gamma != 1:
+        return "scene isn't using the Standard view transform"
+    if scene.camera is None or scene.camera.data.type != 'PERSP':
+        return "scene doesn't have a perspective camera"
+    if world_color(scene) is None:
+        return "world isn't a solid color"
+
+    if scene.sequence_editor is not None and \
+            any(strip.type != 'SOUND' for strip in scene.sequence_editor.sequences_all):
+        return "scene has video strips"
+
+    bpy.context.window.scene = scene
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    for instance in depsgraph.object_instances:
+        obj = instance.object
+        if obj.type not in GEOMETRY_TYPES:
+            continue
+
+        mesh = obj.to_mesh()
+        try:
+            for material in object_materials(obj, mesh):
+                if classify_material(material) is None:
+                    return "{} uses material {}".format(
+                        obj.name, material.name if material else None)
+        finally:
+            obj.to_mesh_clear()
+
+    return None
+
+
+def load_image(image):
+    if image.packed_file is not None:
+        source = Image.open(io.BytesIO(image.packed_file.data))
+    else:
+        source = Image.open(bpy.path.abspath(image.filepath_from_user()))
+
+    return source.convert('RGBA')
+
+
+def perspective_coefficients(screen, source):
+    # PIL maps output pixels back to source pixels, solve the homography
+    # taking the screen quad onto the source corners
+    matrix = []
+    for (x, y), (u, v) in zip(screen, source):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+
+    return numpy.linalg.solve(numpy.array(matrix, dtype=numpy.float64),
+                              numpy.array(source, dtype=numpy.float64).reshape(8))
+
+
+class FlatRenderer:
+    def __init__(self, scene):
+        self.scene = scene
+        self.scale = scene.render.resolution_percentage / 100
+        self.width = int(scene.render.resolution_x * self.scale)
+        self.height = int(scene.render.resolution_y * self.scale)
+        self.background = world_color(scene)
+        self.images = {}
+
+    def source_image(self, image):
+        if image.name not in self.images:
+            self.images[image.name] = load_image(image)
+
+        return self.images[image.name]
+
+    def project(self, obj_matrix, view_projection, view, mesh):
+        co = numpy.empty(len(mesh.vertices) * 3, dtype=numpy.float64)
+        mesh.vertices.foreach_get('co', co)
+        co = numpy.hstack((co.reshape(-1, 3), numpy.ones((len(mesh.vertices), 1))))
+
+        clip = co @ (view_projection @ obj_matrix).T
+        depth = -(co @ (view @ obj_matrix).T)[:, 2]
+
+        w = clip[:, 3:4]
+        in_front = w[:, 0] > 1e-6
+        ndc = clip[:, :2] / numpy.where(in_front, w[:, 0], 1)[:, None]
+
+        screen = numpy.empty((len(co), 2))
+        screen[:, 0] = (ndc[:, 0] + 1) / 2 * self.width * SUPERSAMPLE
+        screen[:, 1] = (1 - ndc[:, 1]) / 2 * self.height * SUPERSAMPLE
+
+        return screen, depth, in_front
+
+    def draw_items(self, obj, matrix, view_projection, view):
+        # (depth, kind, points, fill) for every triangle or image quad of obj
+        items = []
+        mesh = obj.to_mesh()
+
+        try:
+            materials = [classify_material(material)
+                         for material in object_materials(obj, mesh)]
+            screen, depth, in_front = self.project(matrix, view_projection, view, mesh)
+
+            mesh.calc_loop_triangles()
+            triangles = numpy.empty(len(mesh.loop_triangles) * 3, dtype=numpy.int32)
+            mesh.loop_triangles.foreach_get('vertices', triangles)
+            triangles = triangles.reshape(-1, 3)
+            triangle_materials = numpy.empty(len(mesh.loop_triangles), dtype=numpy.int32)
+            mesh.loop_triangles.foreach_get('material_index', triangle_materials)
+
+            triangle_depths = depth[triangles].mean(axis=1)
+            visible = in_front[triangles].all(axis=1)
+
+            for index in numpy.nonzero(visible)[0]:
+                material = materials[min(triangle_materials[index], len(materials) - 1)] \
+                    if materials else None
+                if material is not None and material[0] == 'flat':
+                    items.append((triangle_depths[index], 'flat',
+                                  [tuple(p) for p in screen[triangles[index]]], material[1]))
+
+            uv_layer = mesh.uv_layers.active
+            for polygon in mesh.polygons:
+                material = materials[min(polygon.material_index, len(materials) - 1)] \
+                    if materials else None
+                if material is None or material[0] != 'image' or polygon.loop_total != 4 or uv_layer is None:
+                    continue
+
+                vertices = list(polygon.vertices)
+                if not in_front[vertices].all():
+                    continue
+
+                source = self.source_image(material[1])
+                uvs = [uv_layer.data[loop].uv for loop in polygon.loop_indices]
+                items.append((depth[vertices].mean(), 'image',
+                              [tuple(p) for p in screen[vertices]],
+                              (source, [(uv[0] * source.width, (1 - uv[1]) * source.height) for uv in uvs])))
+        finally:
+            obj.to_mesh_clear()
+
+        return items
+
+    def draw_image(self, canvas, points, source, corners):
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        left = max(0, int(numpy.floor(min(xs))))
+        top = max(0, int(numpy.floor(min(ys))))
+        right = min(canvas.width, int(numpy.ceil(max(xs))))
+        bottom = min(canvas.height, int(numpy.ceil(max(ys))))
+
+        if right <= left or bottom <= top:
+            return
+
+        # warp only the covered box, relative to its corner
+        coefficients = perspective_coefficients(
+            [(x - left, y - top) for x, y in points], corners)
+        # outside the source image the layer stays transparent
+        layer = source.transform((right - left, bottom - top), Image.PERSPECTIVE,
+                                 tuple(coefficients), Image.BILINEAR)
+
+        canvas.alpha_composite(layer, dest=(left, top))
+
+    def render(self, frame):
+        scene = self.scene
+        scene.frame_set(frame)
+
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        camera = scene.camera.evaluated_get(depsgraph)
+        view = camera.matrix_world.inverted()
+        projection = camera.calc_matrix_camera(
+            depsgraph, x=self.width, y=self.height,
+            scale_x=scene.render.pixel_aspect_x, scale_y=scene.render.pixel_aspect_y)
+        view_projection = numpy.array(projection @ view)
+        view = numpy.array(view)
+
+        items = []
+        for instance in depsgraph.object_instances:
+            obj = instance.object
+            if obj.type not in GEOMETRY_TYPES or obj.hide_render:
+                continue
+
+            items.extend(self.draw_items(
+                obj, numpy.array(instance.matrix_world), view_projection, view))
+
+        canvas = Image.new('RGBA', (self.width * SUPERSAMPLE, self.height * SUPERSAMPLE),
+                           self.background + (255,))
+        draw = ImageDraw.Draw(canvas)
+
+        # painter's order, farthest first
+        for _, kind, points, fill in sorted(items, key=lambda item: -item[0]):
+            if kind == 'flat':
+                draw.polygon(points, fill=fill)
+            else:
+                self.draw_image(canvas, points, *fill)
+
+        return canvas.reduce(SUPERSAMPLE).convert('RGB')
+
+    def frames(self):
+        for frame in range(self.scene.frame_start, self.scene.frame_end + 1, self.scene.frame_step):
+            image = self.render(frame)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format='BMP')
+
+            yield buffer.getvalue()
+
+
+def parity(scene, output, frames=None):
+    # compares composited frames against Eevee renders of the same frames
+    renderer = FlatRenderer(scene)
+    frame_path = "{}.{}.parity.png".format(output, scene.name)
+    report = []
+
+    with eevee.still_output(scene, frame_path):
+        for frame in frames or eevee.sample_frames(scene):
+            reference = eevee.render_frame(
+                scene, frame, scene.eevee.taa_render_samples, frame_path)
+            # loaded images are RGBA with the bottom row first
+            reference = reference.reshape(renderer.height, renderer.width, 4)[::-1, :, :3]
+
+            composited = numpy.asarray(renderer.render(frame), dtype=numpy.float32)
+            difference = numpy.abs(reference - composited)
+            differing = numpy.count_nonzero(
+                difference.max(axis=2) > PARITY_LEVELS) / (renderer.width * renderer.height)
+
+            report.append({
+                'scene': scene.name,
+                'frame': frame,
+                'mean_difference': float(difference.mean()),
+                'max_difference': float(difference.max()),
+                'differing_pixels': differing,
+                'ok': differing <= PARITY_PIXELS,
+            })
+
+    return report
@@ -0,0 +1,125 @@
+import os
+import math
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+# rough eevee throughput for our flat scenes, and the fixed cost of a shard
+# (worker start, downloading the .blend, opening it, uploading the clip)
+SECONDS_PER_FRAME = float(os.environ.get('SHARD_SECONDS_PER_FRAME', 0.25))
+SHARD_OVERHEAD_SECONDS = float(os.environ.get('SHARD_OVERHEAD_SECONDS', 45))
+# keep the overhead at most 1/SHARD_OVERHEAD_RATIO of a shard's time
+SHARD_OVERHEAD_RATIO = float(os.environ.get('SHARD_OVERHEAD_RATIO', 4))
+MAX_SHARDS = int(os.environ.get('MAX_SHARDS', 16))
+SHARD_RETRIES = int(os.environ.get('SHARD_RETRIES', 2))
+
+
+def estimate_seconds(frames):
+    return SHARD_OVERHEAD_SECONDS + frames * SECONDS_PER_FRAME
+
+
+def shard_count(total_frames):
+    render_seconds = total_frames * SECONDS_PER_FRAME
+    target_seconds = SHARD_OVERHEAD_SECONDS * SHARD_OVERHEAD_RATIO
+
+    return max(1, min(MAX_SHARDS, math.ceil(render_seconds / target_seconds)))
+
+
+def plan_shards(jobs):
+    # contiguous, roughly equal frame ranges over the timeline; shards keep
+    # timeline order so their clips concatenate directly. jobs are never
+    # split, their frame ranges are what render clips are cached by
+    total_frames = sum(job['frame_end'] - job['frame_start'] + 1
+                       for job in jobs)
+    shards = shard_count(total_frames)
+    shard_frames = math.ceil(total_frames / shards)
+
+    planned = [{'index': 0, 'jobs': [], 'frames': 0}]
+
+    for job in jobs:
+        shard = planned[-1]
+        if shard['frames'] >= shard_frames:
+            shard = {'index': len(planned), 'jobs': [], 'frames': 0}
+            planned.append(shard)
+
+        shard['jobs'].append({
+            'scene': job['scene'],
+            'frame_start': job['frame_start'],
+            'frame_end': job['frame_end'],
+        })
+        shard['frames'] += job['frame_end'] - job['frame_start'] + 1
+
+    for shard in planned:
+        shard['estimated_seconds'] = estimate_seconds(shard['frames'])
+
+    return planned
+
+
+class LocalQueue:
+    # in-process stand-in for the serverless queue, runs shard jobs through
+    # the same handler
+    def __init__(self, handler, workers=2):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, input):
+        # shards join the submitting job's trace
+        return self.executor.submit(contextvars.copy_context().run, self.handler, {"input": input})
+
+    def result(self, job):
+        return job.result()
+
+
+class RunpodQueue:
+    def __init__(self, endpoint_id, timeout=3600):
+        import runpod
+
+        runpod.api_key = os.environ["RUNPOD_API_KEY"]
+        self.endpoint = runpod.Endpoint(endpoint_id)
+        self.timeout = timeout
+
+    def submit(self, input):
+        return self.endpoint.run(input)
+
+    def result(self, job):
+        deadline = time.monotonic() + self.timeout
+
+        while time.monotonic() < deadline:
+            status = job.status()
+
+            if status == 'COMPLETED':
+                return job.output()
+            if status in ('FAILED', 'CANCELLED', 'TIMED_OUT'):
+                raise Exception("shard job {}".format(status.lower()))
+
+            time.sleep(2)
+
+        raise Exception("shard job timed out")
+
+
+def run_shards(queue, shards, make_input, retries=SHARD_RETRIES):
+    # returns each shard's result by index; only failed shards are resubmitted
+    results = {}
+    attempts = {shard['index']: 0 for shard in shards}
+    pending = {shard['index']: queue.submit(
+        make_input(shard)) for shard in shards}
+    by_index = {shard['index']: shard for shard in shards}
+
+    while pending:
+        index, job = next(iter(pending.items()))
+        del pending[index]
+
+        try:
+            results[index] = queue.result(job)
+        except Exception as e:
+            attempts[index] += 1
+
+            if attempts[index] > retries:
+                raise Exception(
+                    "shard {} failed after {} attempts: {}".format(index, attempts[index], e))
+
+            print("shard {} failed, retrying: {}".format(index, e))
+            pending[index] = queue.submit(make_input(by_index[index]))
+
+    return results
@@ -0,0 +1,241 @@
+import bpy
+import os
+import json
+import numpy
+from contextlib import contextmanager
+
+
+# shader nodes that keep a material flat, anything else that outputs a
+# shader (BSDFs, subsurface, volumes, holdout) needs the full Eevee pipeline
+FLAT_SHADER_NODES = {
+    'ShaderNodeEmission',
+    'ShaderNodeBackground',
+    'ShaderNodeBsdfTransparent',
+    'ShaderNodeMixShader',
+    'ShaderNodeAddShader',
+}
+
+# a calibrated sample count must match the reference render this closely, in
+# 8-bit levels per channel, on all but SAMPLE_DIFF_PIXELS of the pixels
+SAMPLE_DIFF_LEVELS = int(os.environ.get('EEVEE_SAMPLE_DIFF_LEVELS', 2))
+SAMPLE_DIFF_PIXELS = float(os.environ.get('EEVEE_SAMPLE_DIFF_PIXELS', 0.001))
+CALIBRATION_FRAMES = 3
+CALIBRATE_SAMPLES = os.environ.get('EEVEE_CALIBRATE_SAMPLES', '1') == '1'
+# sample counts found by render_story.py --calibrate, per blender version,
+# resolution and profile samples; jobs only look them up
+CALIBRATION_FILE = os.environ.get('EEVEE_CALIBRATION_FILE', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'calibration.json'))
+
+
+def flat_node_tree(node_tree):
+    for node in node_tree.nodes:
+        if node.bl_idname == 'ShaderNodeGroup':
+            if node.node_tree is not None and not flat_node_tree(node.node_tree):
+                return False
+        elif node.bl_idname in ('ShaderNodeOutputMaterial', 'ShaderNodeOutputWorld'):
+            if node.inputs['Volume'].is_linked:
+                return False
+        elif node.bl_idname not in FLAT_SHADER_NODES and \
+                any(output.type == 'SHADER' for output in node.outputs):
+            return False
+
+    return True
+
+
+def flat_material(material):
+    # no material renders with the default grey diffuse
+    if material is None or not material.use_nodes:
+        return False
+
+    return flat_node_tree(material.node_tree)
+
+
+def emission_only(scene):
+    if scene.world is not None and scene.world.use_nodes and \
+            not flat_node_tree(scene.world.node_tree):
+        return False
+
+    # evaluated objects, text gets its materials from geometry nodes
+    bpy.context.window.scene = scene
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    for instance in depsgraph.object_instances:
+        obj = instance.object
+
+        if obj.type == 'VOLUME':
+            return False
+        if obj.type not in ('MESH', 'CURVE', 'FONT', 'SURFACE', 'META', 'CURVES', 'POINTCLOUD'):
+            continue
+        if not obj.material_slots:
+            return False
+
+        if not all(flat_material(slot.material) for slot in obj.material_slots):
+            return False
+
+    return True
+
+
+def prune_features(scene):
+    # nothing in a flat scene receives light, so none of this is visible
+    eevee = scene.eevee
+    eevee.use_gtao = False
+    eevee.use_ssr = False
+    eevee.use_ssr_refraction = False
+    eevee.use_bloom = False
+    eevee.use_soft_shadows = False
+    eevee.use_volumetric_lights = False
+    eevee.use_volumetric_shadows = False
+    eevee.use_motion_blur = False
+    eevee.use_shadow_high_bitdepth = False
+    eevee.shadow_cube_size = '512'
+    eevee.shadow_cascade_size = '512'
+    eevee.gi_diffuse_bounces = 0
+
+
+def optimize_scene(scene):
+    scene['emission_only'] = emission_only(scene)
+
+    if scene['emission_only']:
+        prune_features(scene)
+
+    return scene['emission_only']
+
+
+@contextmanager
+def still_output(scene, frame_path):
+    # renders stills to frame_path, putting the scene's output settings back after
+    image_settings = scene.render.image_settings
+    saved = (image_settings.file_format, image_settings.color_mode, image_settings.color_depth,
+             scene.render.filepath, scene.frame_current, scene.eevee.taa_render_samples)
+
+    image_settings.file_format = 'PNG'
+    image_settings.color_mode = 'RGB'
+    image_settings.color_depth = '8'
+    scene.render.filepath = frame_path
+    bpy.context.window.scene = scene
+
+    try:
+        yield
+    finally:
+        (image_settings.file_format, image_settings.color_mode, image_settings.color_depth,
+         scene.render.filepath, frame_current, scene.eevee.taa_render_samples) = saved
+        scene.frame_set(frame_current)
+
+        if os.path.exists(frame_path):
+            os.remove(frame_path)
+
+
+def render_frame(scene, frame, samples, filepath):
+    # 8-bit levels, bottom row first, RGBA
+    scene.eevee.taa_render_samples = samples
+    scene.frame_set(frame)
+    bpy.ops.render.render(write_still=True, scene=scene.name)
+
+    image = bpy.data.images.load(filepath)
+    pixels = numpy.empty(len(image.pixels), dtype=numpy.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+
+    return numpy.round(pixels * 255)
+
+
+def matches(reference, candidate):
+    differing = numpy.count_nonzero(
+        numpy.abs(reference - candidate) > SAMPLE_DIFF_LEVELS)
+
+    return differing <= SAMPLE_DIFF_PIXELS * reference.size
+
+
+def sample_frames(scene, count=CALIBRATION_FRAMES):
+    # evenly spread through the scene, away from the first and last frame
+    step = max(1, (scene.frame_end - scene.frame_start) // (count + 1))
+
+    return [scene.frame_start + step * (i + 1) for i in range(count)]
+
+
+def calibration_key(scene):
+    return '{} {}x{}@{} {}'.format(
+        bpy.app.version_string, scene.render.resolution_x, scene.render.resolution_y,
+        scene.render.resolution_percentage, scene.eevee.taa_render_samples)
+
+
+def load_calibration():
+    if not os.path.exists(CALIBRATION_FILE):
+        return {}
+
+    with open(CALIBRATION_FILE, 'r') as f:
+        return json.load(f)
+
+
+def calibrated_samples(scene):
+    # the profile's samples, lowered when a calibration for this setup says
+    # flat scenes look the same with fewer
+    reference_samples = scene.eevee.taa_render_samples
+
+    if not CALIBRATE_SAMPLES or not scene.get('emission_only'):
+        return reference_samples
+
+    calibration = load_calibration().get(calibration_key(scene))
+    if calibration is None:
+        return reference_samples
+
+    return min(reference_samples, calibration['samples'])
+
+
+def calibrate_samples(scene, output):
+    # lowest sample count whose frames can't be told apart from the
+    # profile's, checked by rendering a few frames both ways
+    reference_samples = scene.eevee.taa_render_samples
+
+    if reference_samples <= 1:
+        return reference_samples
+
+    frame_path = "{}.{}.calibrate.png".format(output, scene.name)
+
+    frames = sample_frames(scene)
+
+    with still_output(scene, frame_path):
+        references = [render_frame(scene, frame, reference_samples, frame_path)
+                      for frame in frames]
+
+        # binary search over powers of two below the reference
+        candidates = []
+        samples = 1
+        while samples < reference_samples:
+            candidates.append(samples)
+            samples *= 2
+
+        best = reference_samples
+        low, high = 0, len(candidates) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            if all(matches(reference, render_frame(scene, frame, candidates[middle], frame_path))
+                   for reference, frame in zip(references, frames)):
+                best = candidates[middle]
+                high = middle - 1
+            else:
+                low = middle + 1
+
+    print('{} renders identically with {} of {} samples'.format(
+        scene.name, best, reference_samples))
+
+    return best
+
+
+def record_calibration(scene, samples):
+    # keeps the highest count any calibrated scene needed for this setup
+    calibration = load_calibration()
+    key = calibration_key(scene)
+
+    if key in calibration:
+        samples = max(samples, calibration[key]['samples'])
+
+    calibration[key] = {'samples': samples, 'diff_levels': SAMPLE_DIFF_LEVELS,
+                        'diff_pixels': SAMPLE_DIFF_PIXELS}
+
+    with open(CALIBRATION_FILE + '.tmp', 'w') as f:
+        json.dump(calibration, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(CALIBRATION_FILE + '.tmp', CALIBRATION_FILE)
+
+    return samples
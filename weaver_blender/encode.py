@@ -0,0 +1,158 @@
+import os
+import subprocess
+
+from . import tracing
+
+
+def concat_videos(clips, output):
+    # clips are encoded with the same settings, so they can be joined
+    # without re-encoding
+    with tracing.span('concat', clips=len(clips)):
+        with open('{}.txt'.format(output), 'w') as f:
+            for clip in clips:
+                f.write("file {}\n".format(clip))
+
+        proc = subprocess.run([
+            'ffmpeg',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', '{}.txt'.format(output),
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-y',
+            '{}'.format(output)
+        ])
+
+        os.remove('{}.txt'.format(output))
+
+        if proc.returncode != 0:
+            raise Exception("error combining videos")
+
+
+def concat_and_mux(clips, audio, output):
+    # concat demuxer for the clips plus the audio track, in one pass
+    with tracing.span('concat', clips=len(clips)):
+        with open('{}.txt'.format(output), 'w') as f:
+            for clip in clips:
+                f.write("file {}\n".format(clip))
+
+        proc = subprocess.run([
+            'ffmpeg',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', '{}.txt'.format(output),
+            '-i', audio,
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-y',
+            '{}'.format(output)
+        ])
+
+        os.remove('{}.txt'.format(output))
+
+        if proc.returncode != 0:
+            raise Exception("error combining videos")
+
+
+def start_frame_encoder(fps, audio, output, preset='medium', crf=23):
+    # one encoder for the whole story, frames are written to its stdin as
+    # uncompressed BMPs
+    return subprocess.Popen([
+        'ffmpeg',
+        '-f', 'image2pipe',
+        '-framerate', str(fps),
+        '-c:v', 'bmp',
+        '-i', '-',
+        '-i', audio,
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        '-c:v', 'libx264',
+        '-preset', preset,
+        '-crf', str(crf),
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        '-y',
+        '{}'.format(output)
+    ], stdin=subprocess.PIPE)
+
+
+def finish_frame_encoder(proc):
+    proc.stdin.close()
+
+    if proc.wait() != 0:
+        raise Exception("error encoding frames")
+
+
+def probe_duration(path):
+    proc = subprocess.run([
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'csv=p=0',
+        path
+    ], stdout=subprocess.PIPE)
+
+    if proc.returncode != 0:
+        raise Exception("error probing {}".format(path))
+
+    return float(proc.stdout)
+
+
+def stream_concat(clips, output):
+    # clips is an iterable of paths in playback order, each one is remuxed to
+    # MPEG-TS and piped into a single muxer as soon as it's yielded, so the
+    # concat runs while later clips are still arriving
+    with tracing.span('concat') as span:
+        muxer = subprocess.Popen([
+            'ffmpeg',
+            '-f', 'mpegts',
+            '-i', 'pipe:0',
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            '-y',
+            '{}'.format(output)
+        ], stdin=subprocess.PIPE)
+
+        offset = 0.0
+
+        try:
+            for clip in clips:
+                # every clip starts at zero, shift it to follow the previous one
+                proc = subprocess.run([
+                    'ffmpeg',
+                    '-i', clip,
+                    '-c', 'copy',
+                    '-output_ts_offset', str(offset),
+                    '-muxdelay', '0',
+                    '-muxpreload', '0',
+                    '-f', 'mpegts',
+                    'pipe:1'
+                ], stdout=muxer.stdin)
+
+                if proc.returncode != 0:
+                    raise Exception("error streaming {}".format(clip))
+
+                offset += probe_duration(clip)
+                span['clips'] = span.get('clips', 0) + 1
+        finally:
+            muxer.stdin.close()
+
+        if muxer.wait() != 0:
+            raise Exception("error combining videos")
+
+
+def first_frame(video, output):
+    with tracing.span('thumbnail'):
+        proc = subprocess.run([
+            'ffmpeg',
+            '-i', video,
+            '-vframes', '1',
+            '-q:v', '2',
+            '-y',
+            '{}'.format(output)
+        ])
+
+        if proc.returncode != 0:
+            raise Exception("error getting first frame")
@@ -1,11 +1,10 @@
 import bpy
 import math
-import os
 import random
 from mathutils import Vector
 from mathutils.geometry import intersect_line_plane
 
-from . import animation
+from . import animation, templates
 
 
 def add_audio(name, sound_path, scene, frame_start, library_path):
@@ -26,7 +25,7 @@ def add_audio(name, sound_path, scene, frame_start, library_path):
     return frame_end
 
 
-def add_image(library_path, filepath, scene, stage, location, start_frame, end_frame):
+def add_image(library_path, filepath, scene, stage, location, start_frame, end_frame, storage_key=None):
     stage_points = stage["reference_points"]
     if location == "top":
         point = (stage_points["tr"] + stage_points["tl"]) / 2
@@ -54,20 +53,24 @@ def add_image(library_path, filepath, scene, stage, location, start_frame, end_f
 
     object_name = "screenshot.{}.{}".format(start_frame, end_frame)
 
-    filename = os.path.basename(filepath)
-    file_base = os.path.splitext(filename)[0]
-
-    bpy.ops.import_image.to_plane(
-        files=[{"name": filepath}], align_axis="Z+", shader="EMISSION")
-    image_plane = scene.objects[file_base]
-    image_plane.name = "asset.{}".format(object_name)
-    image_plane.parent = stage["root"]
-    image_data = image_plane.material_slots[0].material.node_tree.nodes['Image Texture'].image
+    image_data = bpy.data.images.load(filepath, check_existing=True)
     image_data.name = "asset.{}".format(object_name)
-    image_data.pack()
+    if storage_key is not None:
+        # lets the render process fetch the image again if it's not packed
+        image_data['storage_key'] = storage_key
+    aspect = image_data.size[0] / image_data.size[1]
+
+    image_plane = bpy.data.objects.new(
+        "asset.{}".format(object_name), templates.image_plane_mesh())
+    image_plane.material_slots[0].link = 'OBJECT'
+    image_plane.material_slots[0].material = templates.image_material(
+        image_data)
+    image_plane.parent = stage["root"]
+    scene.collection.objects.link(image_plane)
 
+    scale = 4 if location != "background" else 25
     image_plane.location = point
-    image_plane.scale = (4, 4, 4) if location != "background" else (25, 25, 25)
+    image_plane.scale = (scale * aspect, scale, scale)
     image_plane.rotation_euler = (math.pi / 2, math.pi / 2, math.pi / 2)
 
     if start_frame is not None and end_frame is not None:
@@ -113,25 +116,14 @@ def add_text(library_path, custom_text, scene, stage, location, start_frame, end
 
     object_name = "text.{}.{}".format(start_frame, end_frame)
 
-    with bpy.data.libraries.load(os.path.join(__file__, '..', '..', 'library.blend')) as (data_from, data_to):
-        data_to.objects = ['DetailText']
-
-    text_object = data_to.objects[0]
+    text_object = templates.copy_object('DetailText')
     text_object.name = object_name
 
     text_object.parent = stage_root
     text_object.location = point
     text_object.rotation_euler = (math.pi / 2, math.pi / 2, math.pi / 2)
 
-    stroke_material = bpy.data.materials.new("TextMaterial")
-    stroke_material.use_nodes = True
-    stroke_material.node_tree.nodes.clear()
-    stroke_emission = stroke_material.node_tree.nodes.new("ShaderNodeEmission")
-    stroke_emission.inputs[0].default_value = (0, 0, 0, 1)
-    stroke_output = stroke_material.node_tree.nodes.new(
-        "ShaderNodeOutputMaterial")
-    stroke_material.node_tree.links.new(
-        stroke_emission.outputs[0], stroke_output.inputs[0])
+    stroke_material = templates.emission_material((0, 0, 0, 1))
 
     text_object.modifiers["GeometryNodes"]["Input_2"] = custom_text
     text_object.modifiers["GeometryNodes"]["Input_3"] = material
@@ -0,0 +1,65 @@
+import bpy
+import os
+
+from . import cache, storage
+
+
+# packed: images embedded in the .blend
+# relative: images copied next to the .blend and referenced with // paths
+# cache: images referenced in place in the shared asset cache
+PACK_POLICIES = ('packed', 'relative', 'cache')
+
+
+def file_images():
+    return [image for image in bpy.data.images if image.source == 'FILE' and image.filepath]
+
+
+def prepare_images(policy, blend_path):
+    if policy not in PACK_POLICIES:
+        raise Exception("unknown pack policy {}".format(policy))
+
+    # drop anything nothing references before deciding what to write out
+    bpy.data.orphans_purge(do_recursive=True)
+
+    asset_cache = cache.default_cache()
+    blend_dir = os.path.dirname(os.path.abspath(blend_path))
+    assets_dir = "{}_assets".format(os.path.splitext(blend_path)[0])
+
+    for image in file_images():
+        if policy == 'packed':
+            if not image.packed_file:
+                image.pack()
+            continue
+
+        if image.packed_file:
+            image.unpack(method='USE_ORIGINAL')
+
+        filepath = os.path.abspath(bpy.path.abspath(image.filepath))
+
+        if policy == 'relative':
+            os.makedirs(assets_dir, exist_ok=True)
+            asset_path = os.path.join(assets_dir, os.path.basename(filepath))
+            if asset_path != filepath:
+                cache.materialize(filepath, asset_path)
+            image.filepath = bpy.path.relpath(asset_path, start=blend_dir)
+        else:
+            image.filepath = asset_cache.materialized.get(filepath, filepath)
+
+
+def resolve_images(asset_workspace):
+    # cache entries can be evicted between generating and rendering, fetch
+    # them again from storage when that happened
+    for image in file_images():
+        if image.packed_file or os.path.exists(bpy.path.abspath(image.filepath)):
+            continue
+
+        if 'storage_key' not in image:
+            print("missing image {}".format(image.filepath))
+            continue
+
+        filepath = os.path.join(
+            asset_workspace, os.path.basename(image.filepath))
+        storage.download_storage_object(
+            image.get('storage_bucket', 'assets'), image['storage_key'], filepath)
+        image.filepath = filepath
+        image.reload()
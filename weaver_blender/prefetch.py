@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def story_asset_keys(story, asset_workspace):
+    # (bucket, storage key, local path) for every asset the story references,
+    # in block order so the first blocks are ready first
+    assets = []
+
+    for block in story['blocks']:
+        directions = block['stage']['directions'] if 'stage' in block else []
+        video_direction = next(
+            (d for d in directions if d['type'] == 'video'), None)
+
+        if 'speech' in block and (video_direction is None or video_direction['data']['id'] == 'walkthrough'):
+            assets.append(('assets', block['speech']['asset']['key'],
+                          "{}/{}".format(asset_workspace, block['id'])))
+
+        if video_direction is not None:
+            video_metadata = story['metadata'][video_direction['data']['id']]
+            assets.append(('assets', video_metadata['key'],
+                          "{}/pre-{}.mp4".format(asset_workspace, block['id'])))
+        elif 'stage' in block:
+            for i, direction in enumerate(directions):
+                if direction['type'] in ('image', 'screenshot') and 'asset' in direction:
+                    assets.append(('assets', direction['asset']['key'],
+                                  "{}/{}_{}".format(asset_workspace, block['id'], i)))
+        elif block.get('type') in ('image', 'screenshot'):
+            if block['type'] == 'image':
+                asset = story['assets'][block['arguments']['image_id']]
+            else:
+                asset = story['assets'][block['arguments']['url_id']]
+
+            if 'storage' in asset:
+                assets.append(('assets', asset['storage']['key'],
+                              "{}/{}_{}".format(asset_workspace, block['id'], asset['id'])))
+
+    return assets
+
+
+def prefetch_story_assets(story, asset_workspace, download, sign=None, max_workers=None):
+    if max_workers is None:
+        max_workers = int(os.environ.get('PREFETCH_WORKERS', 8))
+
+    asset_keys = story_asset_keys(story, asset_workspace)
+
+    if sign is not None:
+        # resolve every signed url up front in one request per bucket
+        buckets = {}
+        for bucket, storage_key, _ in asset_keys:
+            buckets.setdefault(bucket, []).append(storage_key)
+
+        for bucket, storage_keys in buckets.items():
+            sign(bucket, storage_keys)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+
+    for bucket, storage_key, output_path in asset_keys:
+        # the same object can be referenced by several blocks, only fetch it once
+        if (bucket, storage_key) in futures:
+            continue
+
+        futures[(bucket, storage_key)] = executor.submit(
+            fetch_asset, download, bucket, storage_key, output_path)
+
+    executor.shutdown(wait=False)
+
+    return futures
+
+
+def fetch_asset(download, bucket, storage_key, output_path):
+    download(bucket, storage_key, output_path)
+    return output_path
+
+
+def wait_for_asset(assets, storage_key, bucket='assets'):
+    # blocks until the asset has been downloaded, re-raising any download error
+    return assets[(bucket, storage_key)].result()
+
+
+def resolved_assets(asset_paths):
+    # (bucket, storage key, local path) of assets another process downloaded,
+    # as futures that wait_for_asset can read
+    assets = {}
+
+    for bucket, storage_key, path in asset_paths:
+        future = Future()
+        future.set_result(path)
+        assets[(bucket, storage_key)] = future
+
+    return assets
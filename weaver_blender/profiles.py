@@ -0,0 +1,41 @@
+# named render quality settings, 'final' matches what every render used
+# before profiles existed; quality is set by the constant rate factor, with
+# a rate factor blender's ffmpeg writer ignores bitrates
+PROFILES = {
+    'draft': {
+        'resolution_percentage': 50,
+        'taa_render_samples': 4,
+        'frame_step': 2,
+        'ffmpeg_preset': 'REALTIME',
+        'constant_rate_factor': 'LOW',
+        'x264_preset': 'ultrafast',
+        'x264_crf': 30,
+    },
+    'preview': {
+        'resolution_percentage': 50,
+        'taa_render_samples': 16,
+        'frame_step': 1,
+        'ffmpeg_preset': 'REALTIME',
+        'constant_rate_factor': 'MEDIUM',
+        'x264_preset': 'veryfast',
+        'x264_crf': 26,
+    },
+    'final': {
+        'resolution_percentage': 100,
+        'taa_render_samples': 32,
+        'frame_step': 1,
+        'ffmpeg_preset': 'GOOD',
+        'constant_rate_factor': 'MEDIUM',
+        'x264_preset': 'medium',
+        'x264_crf': 23,
+    },
+}
+
+DEFAULT_PROFILE = 'final'
+
+
+def get_profile(name):
+    if name not in PROFILES:
+        raise Exception("unknown render profile {}".format(name))
+
+    return PROFILES[name]
@@ -0,0 +1,458 @@
+import bpy
+import os
+import json
+import hashlib
+import subprocess
+from collections import OrderedDict
+
+from . import composite, eevee, encode, packing, profiles, render_cache, timeline, tracing
+
+
+RENDER_SCRIPT = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'render_story.py')
+
+# 'composite' draws flat scenes without Eevee, anything it can't draw falls
+# back to eevee
+BACKENDS = ('eevee', 'composite')
+
+# rendered frames kept around for reuse, consecutive repeats are the common case
+DEDUP_FRAMES = int(os.environ.get('RENDER_DEDUP_FRAMES', 16))
+
+
+# what a profile sets on a scene, carried in render plans so workers render
+# with the parent's settings
+RENDER_SETTINGS = ('resolution_percentage', 'taa_render_samples', 'frame_step',
+                   'ffmpeg_preset', 'constant_rate_factor')
+
+
+def configure_scene(scene, profile=profiles.DEFAULT_PROFILE):
+    settings = profiles.get_profile(profile)
+
+    # clips go in the job's workspace, jobs can share a machine
+    scene.render.filepath = os.path.join(
+        os.environ.get('ASSET_WORKSPACE', '/tmp'), "{}.mp4".format(scene.name))
+    apply_render_settings(scene, settings)
+
+
+def apply_render_settings(scene, settings):
+    scene.render.image_settings.file_format = 'FFMPEG'
+    scene.render.ffmpeg.format = 'MPEG4'  # Matroska?
+    scene.render.ffmpeg.audio_codec = 'NONE'
+    scene.render.ffmpeg.ffmpeg_preset = settings['ffmpeg_preset']
+    scene.render.ffmpeg.constant_rate_factor = settings['constant_rate_factor']
+    scene.render.resolution_percentage = settings['resolution_percentage']
+    scene.eevee.taa_render_samples = settings['taa_render_samples']
+    # skipped frames are made up for by a lower output frame rate, so clips
+    # keep their duration
+    scene.frame_step = settings['frame_step']
+    scene.render.fps_base = settings['frame_step']
+
+
+def render_settings(scene):
+    # the inverse of apply_render_settings
+    return {
+        'resolution_percentage': scene.render.resolution_percentage,
+        'taa_render_samples': scene.eevee.taa_render_samples,
+        'frame_step': scene.frame_step,
+        'ffmpeg_preset': scene.render.ffmpeg.ffmpeg_preset,
+        'constant_rate_factor': scene.render.ffmpeg.constant_rate_factor,
+    }
+
+
+def video_scenes(profile=profiles.DEFAULT_PROFILE):
+    scenes = []
+
+    for scene in bpy.data.scenes:
+        if 'Video' in scene.name:
+            configure_scene(scene, profile)
+            eevee.optimize_scene(scene)
+
+            scenes.append(scene)
+
+    return scenes
+
+
+def worker_count():
+    if 'RENDER_WORKERS' in os.environ:
+        return max(1, int(os.environ['RENDER_WORKERS']))
+
+    cpus = os.cpu_count() or 1
+    # each worker holds its own copy of the .blend and its GPU buffers
+    worker_memory = int(os.environ.get(
+        'RENDER_WORKER_MEMORY', 4 * 1024 ** 3))
+
+    available_memory = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available_memory = int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+
+    workers = cpus // 2
+    if available_memory is not None:
+        workers = min(workers, available_memory // worker_memory)
+
+    return max(1, min(workers, int(os.environ.get('RENDER_MAX_WORKERS', 8))))
+
+
+def plan_render_jobs(scenes, chunk_frames=timeline.RENDER_CHUNK_FRAMES):
+    # long scenes are split into chunks, see timeline.chunk_ranges
+    jobs = []
+    for scene in scenes:
+        chunks = timeline.chunk_ranges(scene.frame_start, scene.frame_end, chunk_frames)
+
+        for frame_start, frame_end in chunks:
+            if len(chunks) == 1:
+                filepath = scene.render.filepath
+            else:
+                filepath = "{}.{}-{}.mp4".format(
+                    os.path.splitext(scene.render.filepath)[0], frame_start, frame_end)
+
+            jobs.append({
+                'scene': scene.name,
+                'frame_start': frame_start,
+                'frame_end': frame_end,
+                'filepath': filepath,
+                'cache_key': render_cache_key(scene, frame_start, frame_end),
+                'settings': render_settings(scene),
+            })
+
+    return jobs
+
+
+def assign_workers(jobs, workers):
+    # longest first onto the least loaded worker
+    loads = [0] * workers
+    for job in sorted(jobs, key=lambda job: job['frame_start'] - job['frame_end']):
+        worker = loads.index(min(loads))
+        job['worker'] = worker
+        loads[worker] += job['frame_end'] - job['frame_start'] + 1
+
+
+def render_cache_key(scene, frame_start, frame_end):
+    # scenes from before content hashes existed are always rendered
+    if 'content_hash' not in scene:
+        return None
+
+    return render_cache.content_hash(
+        scene['content_hash'], frame_start, frame_end, bpy.app.version_string,
+        scene.render.resolution_x, scene.render.resolution_y, scene.render.resolution_percentage,
+        scene.render.fps, scene.render.fps_base, scene.frame_step,
+        scene.eevee.taa_render_samples, scene.get('emission_only', False),
+        scene.render.ffmpeg.format, scene.render.ffmpeg.codec,
+        scene.render.ffmpeg.constant_rate_factor, scene.render.ffmpeg.ffmpeg_preset,
+        scene.render.ffmpeg.video_bitrate)
+
+
+def render_job(job):
+    scene = bpy.data.scenes[job['scene']]
+
+    scene.frame_start = job['frame_start']
+    scene.frame_end = job['frame_end']
+    scene.render.filepath = job['filepath']
+    if 'settings' in job:
+        apply_render_settings(scene, job['settings'])
+    if 'taa_render_samples' in job:
+        scene.eevee.taa_render_samples = job['taa_render_samples']
+
+    # with a frame step the last rendered frame can stand for fewer frames
+    # than the others, stretch the clip's frame rate so it lasts exactly as
+    # long as its frames on the timeline
+    frames = len(range(job['frame_start'], job['frame_end'] + 1, scene.frame_step))
+    scene.render.fps_base = (job['frame_end'] - job['frame_start'] + 1) / frames
+
+    bpy.context.window.scene = scene
+
+    with tracing.span('render_scene', scene=scene.name, frame_start=job['frame_start'], frame_end=job['frame_end'],
+                      frames=len(range(job['frame_start'], job['frame_end'] + 1, scene.frame_step))):
+        bpy.ops.render.render(animation=True, scene=scene.name)
+
+
+def run_render_worker(plan_path, worker):
+    # renders this worker's share of a plan with the settings the parent
+    # chose, instead of configuring scenes from a profile again
+    with open(plan_path, 'r') as f:
+        jobs = [job for job in json.load(f) if job['worker'] == worker]
+
+    for scene_name in set(job['scene'] for job in jobs):
+        eevee.optimize_scene(bpy.data.scenes[scene_name])
+
+    for job in jobs:
+        render_job(job)
+
+
+def start_render_workers(jobs, script_path, plan_path, blend_path):
+    with open(plan_path, 'w') as f:
+        json.dump(jobs, f)
+
+    workers = sorted(set(job['worker'] for job in jobs))
+
+    return [subprocess.Popen([bpy.app.binary_path, "--background", blend_path, "--python-exit-code", "1",
+                              "--python", script_path, "--",
+                              "--plan", plan_path, "--worker", str(worker)]) for worker in workers]
+
+
+def wait_render_workers(procs):
+    failed = [proc for proc in procs if proc.wait() != 0]
+
+    if failed:
+        print("error rendering, {} worker(s) failed".format(len(failed)))
+        raise Exception("error rendering")
+
+
+def render_clips(jobs, output, workers):
+    # only blocks whose content changed since they were last rendered
+    pending = [job for job in jobs if job['cache_key'] is None or
+               not render_cache.lookup(job['cache_key'], job['filepath'])]
+    workers = max(1, min(workers, len(pending)))
+    assign_workers(pending, workers)
+
+    print('rendering {} of {} clips'.format(len(pending), len(jobs)))
+
+    for job in pending:
+        job['taa_render_samples'] = eevee.calibrated_samples(
+            bpy.data.scenes[job['scene']])
+
+    procs = []
+    blend_path = bpy.data.filepath
+
+    if workers > 1:
+        if not blend_path:
+            # generated in this process, workers need a copy on disk to open
+            blend_path = '{}.render.blend'.format(output)
+            with tracing.span('save_blend', path=blend_path):
+                packing.prepare_images('cache', blend_path)
+                bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
+
+        procs = start_render_workers(
+            pending, RENDER_SCRIPT, '{}.plan.json'.format(output), blend_path)
+
+    return pending, procs, blend_path
+
+
+def finish_clips(pending, procs, output, blend_path):
+    if procs:
+        with tracing.span('wait_render_workers', workers=len(procs)):
+            wait_render_workers(procs)
+        os.remove('{}.plan.json'.format(output))
+
+        if blend_path != bpy.data.filepath:
+            os.remove(blend_path)
+    else:
+        for job in pending:
+            render_job(job)
+
+    for job in pending:
+        if job['cache_key'] is not None:
+            render_cache.store(job['cache_key'], job['filepath'])
+
+
+def mixdown(output):
+    sequence_scene = bpy.data.scenes['Sequence']
+
+    bpy.context.window.scene = sequence_scene
+    sequence_scene.render.ffmpeg.audio_codec = 'AAC'
+
+    with tracing.span('mixdown'):
+        bpy.ops.sound.mixdown(filepath=output)
+
+
+def shard_jobs(shard):
+    jobs = []
+
+    for job in shard['jobs']:
+        scene = bpy.data.scenes[job['scene']]
+
+        jobs.append({
+            'scene': job['scene'],
+            'frame_start': job['frame_start'],
+            'frame_end': job['frame_end'],
+            'filepath': "{}.{}-{}.mp4".format(
+                os.path.splitext(scene.render.filepath)[0], job['frame_start'], job['frame_end']),
+            'cache_key': render_cache_key(scene, job['frame_start'], job['frame_end']),
+            'settings': render_settings(scene),
+        })
+
+    return jobs
+
+
+def render_shard(shard, output, workers=None):
+    # renders part of the timeline into a single video-only clip
+    jobs = shard_jobs(shard)
+
+    pending, procs, blend_path = render_clips(
+        jobs, output, workers or worker_count())
+    finish_clips(pending, procs, output, blend_path)
+
+    encode.concat_videos([job['filepath'] for job in jobs], output)
+
+    for job in jobs:
+        os.remove(job['filepath'])
+
+
+def dedup_safe(scene):
+    # the fingerprint only covers objects and strips, anything else that
+    # animates or depends on neighbouring frames has to be rendered every frame
+    if scene.eevee.use_motion_blur:
+        return False
+
+    for collection in (bpy.data.materials, bpy.data.worlds, bpy.data.node_groups,
+                       bpy.data.cameras, bpy.data.lights, bpy.data.shape_keys):
+        for datablock in collection:
+            if datablock.animation_data is not None and \
+                    (datablock.animation_data.action is not None or datablock.animation_data.drivers):
+                return False
+
+    return True
+
+
+def frame_fingerprint(scene):
+    # everything that changes between frames of our scenes: what's visible,
+    # where it is, and which strips are playing
+    state = [scene.name, scene.camera.name if scene.camera else None]
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    for instance in depsgraph.object_instances:
+        obj = instance.object
+        if obj.hide_render:
+            continue
+
+        state.append((obj.name, instance.is_instance,
+                      [round(v, 6) for row in instance.matrix_world for v in row]))
+
+    if scene.sequence_editor is not None:
+        for strip in scene.sequence_editor.sequences_all:
+            if strip.type == 'SOUND' or strip.mute:
+                continue
+            if strip.frame_final_start <= scene.frame_current < strip.frame_final_end:
+                state.append((strip.name, scene.frame_current - strip.frame_final_start))
+
+    return hashlib.sha256(repr(state).encode('utf-8')).digest()
+
+
+def render_frames(scene, frame_path):
+    # yields each frame's image, rendering each distinct state only once
+    dedup = dedup_safe(scene)
+    rendered = OrderedDict()
+    stats = {'frames': 0, 'rendered': 0}
+
+    for frame in range(scene.frame_start, scene.frame_end + 1, scene.frame_step):
+        scene.frame_set(frame)
+        stats['frames'] += 1
+
+        fingerprint = frame_fingerprint(scene) if dedup else None
+
+        if fingerprint is not None and fingerprint in rendered:
+            rendered.move_to_end(fingerprint)
+            yield rendered[fingerprint]
+            continue
+
+        bpy.ops.render.render(write_still=True, scene=scene.name)
+        stats['rendered'] += 1
+
+        with open(frame_path, 'rb') as f:
+            image = f.read()
+
+        if fingerprint is not None:
+            rendered[fingerprint] = image
+            if len(rendered) > DEDUP_FRAMES:
+                rendered.popitem(last=False)
+
+        yield image
+
+    print('{}: rendered {} of {} frames'.format(
+        scene.name, stats['rendered'], stats['frames']))
+
+
+def scene_frames(scene, output, backend):
+    if backend == 'composite':
+        reason = composite.incompatible(scene)
+        if reason is None:
+            return composite.FlatRenderer(scene).frames()
+
+        print('rendering {} with eevee, {}'.format(scene.name, reason))
+
+    scene.eevee.taa_render_samples = eevee.calibrated_samples(scene)
+    scene.render.image_settings.file_format = 'BMP'
+    scene.render.image_settings.color_mode = 'RGB'
+    scene.render.filepath = "{}.frame.bmp".format(output)
+    bpy.context.window.scene = scene
+
+    return render_frames(scene, scene.render.filepath)
+
+
+def render_story_piped(output, scenes, profile=profiles.DEFAULT_PROFILE, backend='eevee'):
+    # renders every frame in this process straight into a single encoder,
+    # no per-scene containers to write and read back
+    mixdown("{}.mp3".format(output))
+
+    settings = profiles.get_profile(profile)
+    # encoded at the timeline's frame rate, a frame step repeats frames
+    # instead of slowing the stream, so it stays in sync with the audio
+    encoder = encode.start_frame_encoder(
+        scenes[0].render.fps, "{}.mp3".format(output), output,
+        preset=settings['x264_preset'], crf=settings['x264_crf'])
+    frame_path = "{}.frame.bmp".format(output)
+
+    for scene in scenes:
+        with tracing.span('render_scene', scene=scene.name, backend=backend) as span:
+            span['frames'] = 0
+            frames = range(scene.frame_start, scene.frame_end + 1, scene.frame_step)
+            for image, frame in zip(scene_frames(scene, output, backend), frames):
+                for _ in range(min(scene.frame_step, scene.frame_end + 1 - frame)):
+                    encoder.stdin.write(image)
+                span['frames'] += 1
+
+    with tracing.span('encode'):
+        encode.finish_frame_encoder(encoder)
+
+    if os.path.exists(frame_path):
+        os.remove(frame_path)
+    os.remove('{}.mp3'.format(output))
+
+    print('done')
+
+
+def render_story(output, scenes, workers=None, pipe=None, profile=profiles.DEFAULT_PROFILE, backend=None):
+    # the whole render, what a job reports as its render time
+    with tracing.span('render', profile=profile):
+        render_story_scenes(output, scenes, workers, pipe, profile, backend)
+
+
+def render_story_scenes(output, scenes, workers, pipe, profile, backend):
+    if pipe is None:
+        pipe = os.environ.get('RENDER_PIPE') == '1'
+    if backend is None:
+        backend = os.environ.get('RENDER_BACKEND', 'eevee')
+
+    if backend not in BACKENDS:
+        raise Exception("unknown render backend {}".format(backend))
+
+    # composited frames can only be streamed
+    if pipe or backend == 'composite':
+        return render_story_piped(output, scenes, profile, backend)
+
+    workers = workers or worker_count()
+
+    jobs = plan_render_jobs(scenes)
+
+    pending, procs, blend_path = render_clips(jobs, output, workers)
+
+    # mix audio while the workers render
+    mixdown("{}.mp3".format(output))
+
+    finish_clips(pending, procs, output, blend_path)
+
+    encode.concat_and_mux([job['filepath'] for job in jobs],
+                          "{}.mp3".format(output), output)
+
+    print('render complete, cleaning up')
+
+    os.remove('{}.mp3'.format(output))
+
+    for job in jobs:
+        os.remove(job['filepath'])
+
+    print('done')
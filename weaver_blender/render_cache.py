@@ -0,0 +1,54 @@
+import os
+import json
+import hashlib
+
+from . import cache, storage
+
+
+RENDER_CACHE_BUCKET = os.environ.get('RENDER_CACHE_BUCKET')
+# bump when scene construction changes what a block looks like
+CACHE_VERSION = 1
+
+_render_cache = None
+
+
+def render_cache():
+    global _render_cache
+
+    if _render_cache is None:
+        _render_cache = cache.AssetCache(
+            os.environ.get('RENDER_CACHE_DIR', os.path.join(
+                os.environ.get('ASSET_WORKSPACE', '/tmp'), 'weaver-render-cache')),
+            int(os.environ.get('RENDER_CACHE_MAX_BYTES', 20 * 1024 ** 3)))
+
+    return _render_cache
+
+
+def content_hash(*parts):
+    # deterministic across processes and runs, dict key order doesn't matter
+    return hashlib.sha256(json.dumps((CACHE_VERSION,) + parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def lookup(key, output_path):
+    if render_cache().get(key, output_path):
+        return True
+
+    if RENDER_CACHE_BUCKET is None:
+        return False
+
+    try:
+        render_cache().fetch(key, output_path, lambda path: storage.download_storage_object(
+            RENDER_CACHE_BUCKET, "render-cache/{}.mp4".format(key), path))
+    except Exception as e:
+        print("render cache miss for {}: {}".format(key, e))
+        return False
+
+    return True
+
+
+def store(key, rendered_path):
+    render_cache().put(key, rendered_path)
+
+    if RENDER_CACHE_BUCKET is not None:
+        storage.upload_storage_object(
+            RENDER_CACHE_BUCKET, "render-cache/{}.mp4".format(key), rendered_path, "video/mp4", upsert=True)
@@ -0,0 +1,376 @@
+import os
+import re
+import base64
+import hashlib
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import cache, tracing
+
+
+supabase_url = os.environ["SUPABASE_URL"]
+service_role_key = os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = int(os.environ.get('STORAGE_DOWNLOAD_RETRIES', 3))
+# files above this go through the resumable (TUS) endpoint
+RESUMABLE_UPLOAD_THRESHOLD = int(os.environ.get(
+    'STORAGE_RESUMABLE_THRESHOLD', 50 * 1024 * 1024))
+# supabase requires 6MB chunks for resumable uploads
+UPLOAD_CHUNK_SIZE = 6 * 1024 * 1024
+UPLOAD_RETRIES = int(os.environ.get('STORAGE_UPLOAD_RETRIES', 5))
+# long enough to cover prefetching, transcoding and retries for a whole story
+SIGNED_URL_EXPIRES_IN = int(os.environ.get(
+    'STORAGE_SIGNED_URL_EXPIRES_IN', 3600))
+SIGN_BATCH_SIZE = 100
+
+# one pooled keep-alive session per process, shared by every download thread
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=int(os.environ.get('STORAGE_POOL_SIZE', 16))))
+session.mount('http://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=int(os.environ.get('STORAGE_POOL_SIZE', 16))))
+
+# (bucket, storage key) -> (signed url, expiry timestamp)
+signed_urls = {}
+signed_urls_lock = threading.Lock()
+
+# output path -> ETag of the object version downloaded there
+downloaded_etags = {}
+
+
+def cached_signed_url(bucket, storage_key):
+    with signed_urls_lock:
+        cached = signed_urls.get((bucket, storage_key))
+
+    # leave a margin so a url doesn't expire halfway through a download
+    if cached is not None and cached[1] - 60 > time.time():
+        return cached[0]
+
+    return None
+
+
+def remember_signed_url(bucket, storage_key, signed_path, expires_in):
+    signed_url = "{}/storage/v1/{}".format(supabase_url, signed_path.lstrip('/'))
+
+    with signed_urls_lock:
+        signed_urls[(bucket, storage_key)] = (
+            signed_url, time.time() + expires_in)
+
+    return signed_url
+
+
+def sign_storage_objects(bucket, storage_keys, expires_in=SIGNED_URL_EXPIRES_IN):
+    missing = []
+    for storage_key in storage_keys:
+        if storage_key not in missing and cached_signed_url(bucket, storage_key) is None:
+            missing.append(storage_key)
+
+    with tracing.span('sign', bucket=bucket, count=len(missing)):
+        for i in range(0, len(missing), SIGN_BATCH_SIZE):
+            res = session.post(
+                "{}/storage/v1/object/sign/{}".format(supabase_url, bucket),
+                headers={
+                    'Authorization': 'Bearer {}'.format(service_role_key),
+                    'Content-Type': 'application/json',
+                },
+                json={
+                    "expiresIn": expires_in,
+                    "paths": missing[i:i + SIGN_BATCH_SIZE],
+                }
+            )
+
+            if res.status_code != 200:
+                print(res.text)
+                raise Exception("error getting signed urls")
+
+            for signed in res.json():
+                if signed.get('error') or not signed.get('signedURL'):
+                    # left unsigned, the download will sign it on its own and
+                    # surface the error there
+                    print("error signing {}: {}".format(
+                        signed.get('path'), signed.get('error')))
+                    continue
+
+                remember_signed_url(
+                    bucket, signed['path'], signed['signedURL'], expires_in)
+
+    return {storage_key: cached_signed_url(bucket, storage_key) for storage_key in storage_keys}
+
+
+def sign_storage_object(bucket, storage_key, expires_in=SIGNED_URL_EXPIRES_IN):
+    cached = cached_signed_url(bucket, storage_key)
+    if cached is not None:
+        return cached
+
+    res = session.post(
+        "{}/storage/v1/object/sign/{}/{}".format(
+            supabase_url, bucket, storage_key),
+        headers={
+            'Authorization': 'Bearer {}'.format(service_role_key),
+            'Content-Type': 'application/json',
+        },
+        json={
+            "expiresIn": expires_in,
+        }
+    )
+
+    if res.status_code != 200:
+        print(res.text)
+        raise Exception("error getting signed url")
+
+    res_data = res.json()
+
+    return remember_signed_url(bucket, storage_key, res_data['signedURL'], expires_in)
+
+
+def download_signed_url(signed_url, output_path, etag=None, resume=True, if_none_match=None):
+    # returns (modified, etag of the downloaded version); nothing is written
+    # when the object still matches if_none_match
+    part_path = "{}.part".format(output_path)
+
+    if not resume and os.path.exists(part_path):
+        os.remove(part_path)
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            modified, response_etag = stream_to_file(
+                signed_url, part_path, if_none_match)
+            break
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+
+            # keep the partial file, the next attempt resumes from it
+            print("download interrupted, retrying: {}".format(e))
+
+    if not modified:
+        return False, response_etag
+
+    verify_checksum(part_path, etag or response_etag)
+
+    os.replace(part_path, output_path)
+
+    return True, response_etag
+
+
+def stream_to_file(signed_url, part_path, if_none_match=None):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset:
+        headers = {'Range': 'bytes={}-'.format(offset)}
+    elif if_none_match is not None:
+        headers = {'If-None-Match': if_none_match}
+    else:
+        headers = {}
+
+    with session.get(signed_url, headers=headers, stream=True) as fileRes:
+        if fileRes.status_code == 304:
+            return False, if_none_match
+
+        if fileRes.status_code == 416:
+            # the partial file is already complete
+            return True, None
+
+        if fileRes.status_code not in (200, 206):
+            print(fileRes.text)
+            raise Exception("error downloading asset")
+
+        etag = fileRes.headers.get('ETag')
+
+        # server ignored the range, start over
+        mode = "ab" if fileRes.status_code == 206 else "wb"
+
+        if 'Content-Encoding' in fileRes.headers:
+            # lengths refer to the encoded body
+            expected_size = -1
+        elif fileRes.status_code == 206:
+            expected_size = int(fileRes.headers['Content-Range'].split('/')[-1])
+        else:
+            expected_size = int(fileRes.headers.get('Content-Length', -1))
+
+        with open(part_path, mode) as f:
+            for chunk in fileRes.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+    if expected_size >= 0 and os.path.getsize(part_path) != expected_size:
+        raise requests.exceptions.ChunkedEncodingError(
+            "expected {} bytes, got {}".format(expected_size, os.path.getsize(part_path)))
+
+    return True, etag
+
+
+def verify_checksum(path, etag):
+    # single-part uploads get the MD5 of the body as their ETag, multipart
+    # ETags ("<md5>-<parts>") can't be checked against the file
+    if etag is None:
+        return
+
+    etag = etag.strip('"').lower()
+    if etag.startswith('w/') or not re.fullmatch(r'[0-9a-f]{32}', etag):
+        return
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+
+    if md5.hexdigest() != etag:
+        os.remove(path)
+        raise Exception("checksum mismatch downloading asset")
+
+
+def download_storage_object(bucket, storage_key, output_path):
+    with tracing.span('download', bucket=bucket, key=storage_key):
+        signed_url = sign_storage_object(bucket, storage_key)
+        asset_cache = cache.default_cache()
+        version_ref = asset_cache.key(bucket, storage_key)
+
+        # the version cached last time; while it's current the one request
+        # comes back without a body
+        cached_etag = asset_cache.ref(version_ref)
+        if cached_etag is not None and not asset_cache.contains(asset_cache.key(bucket, storage_key, cached_etag)):
+            cached_etag = None
+
+        tmp_path = asset_cache.temp_path()
+        try:
+            start = time.monotonic()
+            modified, etag = download_signed_url(
+                signed_url, tmp_path, if_none_match=cached_etag)
+
+            if not modified and not asset_cache.get(asset_cache.key(bucket, storage_key, etag), output_path):
+                # evicted since we looked
+                modified, etag = download_signed_url(signed_url, tmp_path)
+
+            if modified and etag is None:
+                # can't tell which version this is, don't cache it
+                os.replace(tmp_path, output_path)
+            elif modified:
+                asset_cache.add(asset_cache.key(bucket, storage_key, etag), tmp_path, output_path,
+                                download_seconds=time.monotonic() - start)
+                asset_cache.set_ref(version_ref, etag)
+        finally:
+            # a failed download leaves its partial file behind
+            for path in (tmp_path, "{}.part".format(tmp_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if etag is None:
+            downloaded_etags.pop(os.path.abspath(output_path), None)
+        else:
+            downloaded_etags[os.path.abspath(output_path)] = etag
+
+        return output_path
+
+
+def downloaded_etag(path):
+    # the version of the object last downloaded to path, None if unknown
+    return downloaded_etags.get(os.path.abspath(path))
+
+
+def upload_storage_object(bucket, storage_key, filepath, content_type, upsert=False):
+    with tracing.span('upload', bucket=bucket, key=storage_key, bytes=os.path.getsize(filepath)):
+        if os.path.getsize(filepath) > RESUMABLE_UPLOAD_THRESHOLD:
+            return upload_storage_object_resumable(bucket, storage_key, filepath, content_type, upsert)
+
+        with open(filepath, "rb") as output_blend:
+            # passing the file object streams it instead of reading it into memory
+            with session.post(
+                "{}/storage/v1/object/{}/{}".format(
+                    supabase_url,
+                    bucket,
+                    storage_key
+                ),
+                headers={
+                    'Authorization': 'Bearer {}'.format(service_role_key),
+                    'Content-Type': content_type,
+                    'X-Upsert': str(upsert).lower(),
+                },
+                data=output_blend
+            ) as response:
+                if not response.ok:
+                    print("error uploading asset")
+                    print(response.text)
+                    raise Exception(
+                        "error uploading asset: {}".format(response.text))
+
+
+def upload_storage_object_resumable(bucket, storage_key, filepath, content_type, upsert=False):
+    size = os.path.getsize(filepath)
+
+    metadata = {
+        'bucketName': bucket,
+        'objectName': storage_key,
+        'contentType': content_type,
+    }
+
+    response = session.post(
+        "{}/storage/v1/upload/resumable".format(supabase_url),
+        headers={
+            'Authorization': 'Bearer {}'.format(service_role_key),
+            'Tus-Resumable': '1.0.0',
+            'Upload-Length': str(size),
+            'Upload-Metadata': ','.join('{} {}'.format(k, base64.b64encode(v.encode('utf-8')).decode('ascii')) for k, v in metadata.items()),
+            'X-Upsert': str(upsert).lower(),
+        }
+    )
+
+    if response.status_code != 201:
+        print("error creating resumable upload")
+        print(response.text)
+        raise Exception(
+            "error creating resumable upload: {}".format(response.text))
+
+    upload_url = response.headers['Location']
+    offset = 0
+    failures = 0
+
+    with open(filepath, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+
+            try:
+                response = session.patch(
+                    upload_url,
+                    headers={
+                        'Authorization': 'Bearer {}'.format(service_role_key),
+                        'Tus-Resumable': '1.0.0',
+                        'Upload-Offset': str(offset),
+                        'Content-Type': 'application/offset+octet-stream',
+                    },
+                    data=chunk
+                )
+                ok = response.status_code == 204
+            except requests.ConnectionError as e:
+                print("chunk upload interrupted: {}".format(e))
+                ok = False
+
+            if ok:
+                offset = int(response.headers['Upload-Offset'])
+                failures = 0
+                continue
+
+            failures += 1
+            if failures > UPLOAD_RETRIES:
+                raise Exception("error uploading asset: chunk at offset {} failed".format(offset))
+
+            # only the failed chunk is resent, from wherever the server got to
+            offset = resumable_upload_offset(upload_url)
+
+
+def resumable_upload_offset(upload_url):
+    response = session.head(
+        upload_url,
+        headers={
+            'Authorization': 'Bearer {}'.format(service_role_key),
+            'Tus-Resumable': '1.0.0',
+        }
+    )
+
+    if response.status_code != 200:
+        print(response.text)
+        raise Exception("error resuming upload")
+
+    return int(response.headers['Upload-Offset'])
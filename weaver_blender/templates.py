@@ -0,0 +1,149 @@
+import bpy
+import os
+from bpy.app.handlers import persistent
+
+
+LIBRARY_PATH = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'library.blend')
+
+templates = {}
+materials = {}
+image_materials = {}
+
+stats = {
+    'library_loads': 0,
+    'library_loads_avoided': 0,
+    'materials_created': 0,
+    'materials_reused': 0,
+}
+
+
+@persistent
+def clear_templates(*args):
+    # datablocks from the previous file are gone after a load or reset
+    templates.clear()
+    materials.clear()
+    image_materials.clear()
+
+
+if clear_templates not in bpy.app.handlers.load_post:
+    bpy.app.handlers.load_post.append(clear_templates)
+
+
+def template_object(name):
+    if name in templates:
+        stats['library_loads_avoided'] += 1
+        return templates[name]
+
+    with bpy.data.libraries.load(LIBRARY_PATH) as (data_from, data_to):
+        data_to.objects = [name]
+
+    stats['library_loads'] += 1
+
+    template = data_to.objects[0]
+    template.name = "template.{}".format(name)
+    # not linked to any scene, keep it around for the next copy
+    template.use_fake_user = True
+    templates[name] = template
+
+    return template
+
+
+def copy_object(name):
+    # copies share the template's mesh and geometry node group
+    return template_object(name).copy()
+
+
+def emission_material(color, name="TextMaterial"):
+    key = (name, tuple(round(c, 4) for c in color))
+
+    if key in materials:
+        stats['materials_reused'] += 1
+        return materials[key]
+
+    material = bpy.data.materials.new(name)
+    material.use_nodes = True
+    material.node_tree.nodes.clear()
+    emission = material.node_tree.nodes.new("ShaderNodeEmission")
+    emission.inputs[0].default_value = color
+    output = material.node_tree.nodes.new(
+        "ShaderNodeOutputMaterial")
+    material.node_tree.links.new(
+        emission.outputs[0], output.inputs[0])
+
+    stats['materials_created'] += 1
+    materials[key] = material
+
+    return material
+
+
+def image_plane_mesh():
+    # unit quad facing +Z, planes scale it to their image's aspect ratio
+    if 'ImagePlane' in templates:
+        return templates['ImagePlane']
+
+    mesh = bpy.data.meshes.new("ImagePlane")
+    mesh.from_pydata(
+        [(-0.5, -0.5, 0), (0.5, -0.5, 0), (0.5, 0.5, 0), (-0.5, 0.5, 0)], [], [(0, 1, 2, 3)])
+    uv_layer = mesh.uv_layers.new(name="UVMap")
+    for loop, uv in zip(uv_layer.data, ((0, 0), (1, 0), (1, 1), (0, 1))):
+        loop.uv = uv
+    # the material itself is linked per object
+    mesh.materials.append(None)
+    mesh.use_fake_user = True
+
+    templates['ImagePlane'] = mesh
+
+    return mesh
+
+
+def image_plane_shader():
+    if 'ImagePlaneShader' in templates:
+        return templates['ImagePlaneShader']
+
+    group = bpy.data.node_groups.new("ImagePlaneShader", "ShaderNodeTree")
+    group.inputs.new("NodeSocketColor", "Color")
+    group.inputs.new("NodeSocketFloat", "Alpha")
+    group.outputs.new("NodeSocketShader", "Shader")
+
+    group_input = group.nodes.new("NodeGroupInput")
+    group_output = group.nodes.new("NodeGroupOutput")
+    emission = group.nodes.new("ShaderNodeEmission")
+    transparent = group.nodes.new("ShaderNodeBsdfTransparent")
+    mix = group.nodes.new("ShaderNodeMixShader")
+
+    group.links.new(group_input.outputs["Color"], emission.inputs["Color"])
+    group.links.new(group_input.outputs["Alpha"], mix.inputs["Fac"])
+    group.links.new(transparent.outputs[0], mix.inputs[1])
+    group.links.new(emission.outputs[0], mix.inputs[2])
+    group.links.new(mix.outputs[0], group_output.inputs["Shader"])
+    group.use_fake_user = True
+
+    templates['ImagePlaneShader'] = group
+
+    return group
+
+
+def image_material(image):
+    if image.filepath in image_materials:
+        stats['materials_reused'] += 1
+        return image_materials[image.filepath]
+
+    material = bpy.data.materials.new(image.name)
+    material.use_nodes = True
+    material.blend_method = 'BLEND'
+    material.shadow_method = 'CLIP'
+    material.node_tree.nodes.clear()
+    texture = material.node_tree.nodes.new("ShaderNodeTexImage")
+    texture.image = image
+    shader = material.node_tree.nodes.new("ShaderNodeGroup")
+    shader.node_tree = image_plane_shader()
+    output = material.node_tree.nodes.new("ShaderNodeOutputMaterial")
+    material.node_tree.links.new(texture.outputs["Color"], shader.inputs["Color"])
+    material.node_tree.links.new(texture.outputs["Alpha"], shader.inputs["Alpha"])
+    material.node_tree.links.new(shader.outputs["Shader"], output.inputs[0])
+
+    stats['materials_created'] += 1
+    image_materials[image.filepath] = material
+
+    return material
@@ -0,0 +1,377 @@
+import os
+import json
+import math
+import wave
+import hashlib
+
+from . import encode, transcode
+
+
+# bump when the planning rules below change, invalidates cached plans
+TIMELINE_VERSION = 1
+
+FPS = 30
+# frames an asset stays up when nothing follows it closely
+STANDARD_DURATION = 60
+# the camera holds still for this many frames at the end of a block
+BUFFER_FRAMES = 30
+# blocks get their own stage this far apart along Y
+STAGE_SPACING = 30
+# new scenes start here, a block's Video scene runs from it to scene_frame_end
+SCENE_FRAME_START = 1
+# longest clip a single render job covers, workers and shards balance whole chunks
+RENDER_CHUNK_FRAMES = int(os.environ.get('RENDER_CHUNK_FRAMES', 240))
+
+TEXT_POSITIONS = ('top', 'center', 'bottom')
+
+
+class Strip:
+    # a strip in the Sequence scene; kind is 'sound', 'movie' or 'scene'
+    __slots__ = ('kind', 'name', 'channel', 'frame_start', 'frames', 'key', 'segment',
+                 'trim_start', 'trim_end')
+
+    def __init__(self, kind, name, channel, frame_start, frames, key=None, segment=None,
+                 trim_start=None, trim_end=None):
+        self.kind = kind
+        self.name = name
+        self.channel = channel
+        self.frame_start = frame_start
+        self.frames = frames
+        self.key = key
+        self.segment = segment
+        self.trim_start = trim_start
+        self.trim_end = trim_end
+
+    @property
+    def frame_end(self):
+        return self.frame_start + self.frames
+
+
+class Placement:
+    # an image or text on a block's stage, frames are None for ones that stay
+    # up for the whole block
+    __slots__ = ('kind', 'location', 'frame_start', 'frame_end', 'key', 'text')
+
+    def __init__(self, kind, location, frame_start=None, frame_end=None, key=None, text=None):
+        self.kind = kind
+        self.location = location
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.key = key
+        self.text = text
+
+
+class Block:
+    __slots__ = ('id', 'index', 'kind', 'scene_name', 'frame_start', 'frame_end', 'scene_frame_end',
+                 'text_position', 'stage_location', 'camera_frames', 'placements', 'strips')
+
+    def __init__(self, id, index, kind, scene_name, frame_start, frame_end, scene_frame_end=None,
+                 text_position=None, stage_location=None, camera_frames=None, placements=None, strips=None):
+        self.id = id
+        self.index = index
+        # 'scene' blocks are staged in their Video scene, 'video' blocks play footage
+        self.kind = kind
+        self.scene_name = scene_name
+        # in the Sequence scene
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.scene_frame_end = scene_frame_end
+        # text position before this block's first text, see next_text_position
+        self.text_position = text_position
+        self.stage_location = stage_location
+        self.camera_frames = camera_frames or []
+        self.placements = placements or []
+        self.strips = strips or []
+
+
+class Timeline:
+    __slots__ = ('fps', 'frame_end', 'blocks')
+
+    def __init__(self, fps, frame_end, blocks):
+        self.fps = fps
+        self.frame_end = frame_end
+        self.blocks = blocks
+
+    def to_dict(self):
+        return {
+            'version': TIMELINE_VERSION,
+            'fps': self.fps,
+            'frame_end': self.frame_end,
+            'blocks': [dict({name: getattr(block, name) for name in Block.__slots__},
+                            placements=[{name: getattr(p, name) for name in Placement.__slots__}
+                                        for p in block.placements],
+                            strips=[{name: getattr(s, name) for name in Strip.__slots__}
+                                    for s in block.strips])
+                       for block in self.blocks],
+        }
+
+    def render_jobs(self, chunk_frames=RENDER_CHUNK_FRAMES):
+        # what render.plan_render_jobs makes of the built scenes, for planning
+        # shards without opening the .blend
+        return [{'scene': block.scene_name, 'frame_start': frame_start, 'frame_end': frame_end}
+                for block in self.blocks if block.kind == 'scene'
+                for frame_start, frame_end in chunk_ranges(SCENE_FRAME_START, block.scene_frame_end, chunk_frames)]
+
+    @classmethod
+    def from_dict(cls, data):
+        blocks = []
+        for block in data['blocks']:
+            fields = dict(block)
+            fields['stage_location'] = tuple(fields['stage_location']) if fields['stage_location'] else None
+            fields['placements'] = [Placement(**p) for p in block['placements']]
+            fields['strips'] = [Strip(**s) for s in block['strips']]
+            blocks.append(Block(**fields))
+
+        return cls(data['fps'], data['frame_end'], blocks)
+
+
+def chunk_ranges(frame_start, frame_end, chunk_frames=RENDER_CHUNK_FRAMES):
+    # split at fixed offsets from the first frame, so a chunk (and what it's
+    # cached by) doesn't depend on the rest of the story or the worker count
+    return [(start, min(frame_end, start + chunk_frames - 1))
+            for start in range(frame_start, frame_end + 1, chunk_frames)]
+
+
+def next_text_position(position):
+    # top -> center -> bottom -> top, as text is added
+    return TEXT_POSITIONS[(TEXT_POSITIONS.index(position) + 1) % len(TEXT_POSITIONS)]
+
+
+def sound_frames(seconds, fps=FPS):
+    # how Blender sizes a sound strip, rounded to the nearest frame
+    return max(1, int(math.floor(seconds * fps + 0.5)))
+
+
+def audio_duration(path):
+    # from the file header, WAV directly and anything else through ffprobe
+    try:
+        with wave.open(path, 'rb') as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        return encode.probe_duration(path)
+
+
+def speech_keys(story):
+    keys = []
+    for block in story['blocks']:
+        directions = block['stage']['directions'] if 'stage' in block else []
+        video_direction = next((d for d in directions if d['type'] == 'video'), None)
+
+        if 'speech' in block and (video_direction is None or video_direction['data']['id'] == 'walkthrough'):
+            keys.append(block['speech']['asset']['key'])
+
+    return keys
+
+
+def probe_speech(story, speech_path):
+    # speech_path maps a storage key to the downloaded file
+    return {key: audio_duration(speech_path(key)) for key in speech_keys(story)}
+
+
+def plan_video_block(story, block, bi, current_frame, speech_durations, fps):
+    video_direction = next(d for d in block['stage']['directions'] if d['type'] == 'video')
+    video_id = video_direction['data']['id']
+    transcription = story['metadata'][video_id]['transcription']
+    segments = video_direction['data']['segments']
+    strips = []
+
+    if video_id == 'walkthrough':
+        speech_key = block['speech']['asset']['key']
+        audio_frames = sound_frames(speech_durations[speech_key], fps)
+        strips.append(Strip('sound', "{}.speech".format(block['id']), 3, current_frame, audio_frames,
+                            key=speech_key))
+    else:
+        audio_frames = 0
+        for segment in segments:
+            segment_data = transcription[segment]
+            frames = int(segment_data['end'] * fps) - int(segment_data['start'] * fps)
+            strips.append(Strip('sound', "{}.{}.audio".format(block['id'], segment), 3,
+                                current_frame + audio_frames, frames, segment=segment))
+            audio_frames += frames
+
+    # footage is sped up or slowed down to fill the narration
+    video_duration = sum((transcription[segment]['end'] - transcription[segment]['start']) * fps
+                         for segment in segments)
+
+    frame_offset = 0
+    for segment in segments:
+        trim_start, trim_end = transcode.segment_frames(transcription[segment], fps)
+        target_frames = math.ceil(((trim_end - trim_start) / video_duration) * audio_frames)
+        strips.append(Strip('movie', "{}.{}".format(block['id'], segment), 4, current_frame + frame_offset,
+                            target_frames, segment=segment, trim_start=trim_start, trim_end=trim_end))
+        frame_offset += target_frames
+
+    return Block(block['id'], bi, 'video', scene_name(bi), current_frame, current_frame + audio_frames,
+                 strips=strips)
+
+
+def plan_staged_block(block, bi, current_frame, speech_durations, text_position, fps):
+    if 'speech' not in block:
+        raise Exception("block missing speech")
+
+    speech_key = block['speech']['asset']['key']
+    frame_end = sound_frames(speech_durations[speech_key], fps)
+    frame_start = 0
+
+    strips = [
+        Strip('sound', "{}.speech".format(block['id']), 3, current_frame, frame_end, key=speech_key),
+        Strip('scene', block['id'], 4, current_frame, frame_end),
+    ]
+
+    tags = block['speech']['tags']
+    # each direction with its tag (or None), in tag order
+    tagged_directions = sorted(
+        [{'direction': direction, 'tag': tags.get(str(i))}
+         for i, direction in enumerate(block['stage']['directions'])],
+        key=lambda x: x['tag']['timeOffset'] if x['tag'] else 0)
+
+    placements = []
+    first_text_position = text_position
+
+    for i, tagged in enumerate(tagged_directions):
+        direction = tagged['direction']
+        tag = tagged['tag']
+
+        if tag:
+            duration = STANDARD_DURATION
+            tag_frame_start = frame_start + int(tag['timeOffset'] * fps)
+
+            if i < len(tagged_directions) - 1:
+                # if there is a next tag, bridge the gap
+                next_direction = tagged_directions[i + 1]['direction']
+                next_tag = tagged_directions[i + 1]['tag']
+
+                if ('asset' in next_direction or next_direction['type'] == 'text') and next_tag:
+                    next_tag_frame_start = frame_start + int(next_tag['timeOffset'] * fps)
+                    if next_tag_frame_start - tag_frame_start > STANDARD_DURATION:
+                        duration = next_tag_frame_start - tag_frame_start
+            else:
+                # make the asset last until the end of the speech
+                duration = frame_end - tag_frame_start
+
+            frames = (tag_frame_start, tag_frame_start + duration)
+        elif direction['location'] == 'background':
+            frames = (None, None)
+        else:
+            continue
+
+        if direction['type'] in ('image', 'screenshot') and 'asset' in direction:
+            placements.append(Placement('image', direction.get('location', 'center'), *frames,
+                                        key=direction['asset']['key']))
+        elif direction['type'] == 'text':
+            text_position = next_text_position(text_position)
+            placements.append(Placement('text', text_position, *frames, text=direction['data']))
+
+    block_plan = Block(block['id'], bi, 'scene', scene_name(bi), current_frame, current_frame + frame_end,
+                       scene_frame_end=frame_end, text_position=first_text_position,
+                       stage_location=(0, bi * STAGE_SPACING, 0),
+                       camera_frames=[frame_start, frame_end - BUFFER_FRAMES],
+                       placements=placements, strips=strips)
+
+    return block_plan, text_position
+
+
+def plan_summary_block(story, block, bi, current_frame, speech_durations, fps):
+    if 'speech' not in block:
+        raise Exception("block missing speech")
+
+    speech_key = block['speech']['asset']['key']
+    frame_end = sound_frames(speech_durations[speech_key], fps)
+
+    placements = []
+    if block['type'] in ('image', 'screenshot'):
+        if block['type'] == 'image':
+            asset = story['assets'][block['arguments']['image_id']]
+        else:
+            asset = story['assets'][block['arguments']['url_id']]
+
+        if 'storage' in asset:
+            placements.append(Placement('image', 'background', 0, frame_end, key=asset['storage']['key']))
+
+    if story['metadata']['title']:
+        placements.append(Placement('text', 'bottom', text=story['metadata']['title']))
+
+    return Block(block['id'], bi, 'scene', scene_name(bi), current_frame, current_frame + frame_end,
+                 scene_frame_end=frame_end, stage_location=(0, bi * STAGE_SPACING, 0),
+                 camera_frames=[0, frame_end - BUFFER_FRAMES], placements=placements,
+                 strips=[
+                     Strip('sound', "{}.speech".format(block['id']), 3, current_frame, frame_end, key=speech_key),
+                     Strip('scene', block['id'], 4, current_frame, frame_end),
+                 ])
+
+
+def scene_name(index):
+    # names Blender gives scenes created as 'Video' one after another
+    return 'Video' if index == 0 else 'Video.{:03d}'.format(index)
+
+
+def plan_story(story, speech_durations, fps=FPS):
+    # every frame range of a generate_scene.py story, worked out up front
+    blocks = []
+    current_frame = 1
+    text_position = 'top'
+
+    for bi, block in enumerate(story['blocks']):
+        if any(d['type'] == 'video' for d in block['stage']['directions']):
+            block_plan = plan_video_block(story, block, bi, current_frame, speech_durations, fps)
+        else:
+            block_plan, text_position = plan_staged_block(
+                block, bi, current_frame, speech_durations, text_position, fps)
+
+        blocks.append(block_plan)
+        current_frame = block_plan.frame_end
+
+    return Timeline(fps, current_frame, blocks)
+
+
+def plan_summary(story, speech_durations, fps=FPS):
+    # every frame range of a generate_summary.py story, one staged block per
+    # story block, each as long as its speech
+    blocks = []
+    current_frame = 1
+
+    for bi, block in enumerate(story['blocks']):
+        block_plan = plan_summary_block(story, block, bi, current_frame, speech_durations, fps)
+
+        blocks.append(block_plan)
+        current_frame = block_plan.frame_end
+
+    return Timeline(fps, current_frame, blocks)
+
+
+def story_hash(story, fps, planner):
+    return hashlib.sha256(json.dumps((TIMELINE_VERSION, story, fps, planner.__name__),
+                                     sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def timeline_path(story_path):
+    return "{}.timeline.json".format(os.path.splitext(story_path)[0])
+
+
+def load(story_path):
+    # the plan cached by the last load_or_plan of the story, e.g. to shard a
+    # story another process built
+    with open(timeline_path(story_path), 'r') as f:
+        return Timeline.from_dict(json.load(f)['timeline'])
+
+
+def load_or_plan(story_path, story, speech_path, fps=FPS, planner=plan_story):
+    # plans are cached next to the story, a re-run of the same story skips
+    # probing its audio
+    plan_path = timeline_path(story_path)
+    key = story_hash(story, fps, planner)
+
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r') as f:
+            cached = json.load(f)
+
+        if cached.get('key') == key:
+            return Timeline.from_dict(cached['timeline'])
+
+    plan = planner(story, probe_speech(story, speech_path), fps)
+
+    with open(plan_path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'timeline': plan.to_dict()}, f)
+    os.replace(plan_path + '.tmp', plan_path)
+
+    return plan
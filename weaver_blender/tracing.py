@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import threading
+import contextvars
+import sentry_sdk
+from contextlib import contextmanager, ExitStack
+
+
+# passed by the handler to every blender process it starts for a job, so
+# their spans land in the same report
+TRACE_ID_ENV = 'WEAVER_TRACE_ID'
+TRACE_FILE_ENV = 'WEAVER_TRACE_FILE'
+
+# the handler's trace for the job running in this context, jobs run
+# concurrently so it can't live in os.environ
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+local = threading.local()
+open_transactions = 0
+script_transactions = ExitStack()
+
+
+def environ():
+    job_trace = current_trace.get()
+    if job_trace is not None:
+        return {TRACE_ID_ENV: job_trace['trace_id'], TRACE_FILE_ENV: job_trace['file']}
+
+    return {name: os.environ[name] for name in (TRACE_ID_ENV, TRACE_FILE_ENV) if name in os.environ}
+
+
+def submit(executor, fn, *args, **kwargs):
+    # pool threads don't inherit the submitting job's trace on their own
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def write_span(fields):
+    trace_file = environ().get(TRACE_FILE_ENV)
+    if trace_file is None:
+        return
+
+    # one short line per append, so concurrent processes don't interleave
+    with open(trace_file, 'a') as f:
+        f.write(json.dumps(fields) + '\n')
+
+
+def now():
+    return time.time(), time.monotonic()
+
+
+def record(name, started, parent=None, **data):
+    # writes a span that began at started, a now() result
+    seconds = time.monotonic() - started[1]
+
+    if data.get('frames'):
+        data['fps'] = round(data['frames'] / seconds, 3) if seconds > 0 else None
+
+    if parent is None and getattr(local, 'spans', None):
+        parent = local.spans[-1]
+
+    write_span({
+        'name': name,
+        'parent': parent,
+        'start': started[0],
+        'seconds': round(seconds, 4),
+        'pid': os.getpid(),
+        **data,
+    })
+
+
+@contextmanager
+def span(name, **data):
+    # times a phase, extra fields can be added to the yielded dict, a
+    # 'frames' count also reports frames per second
+    parents = getattr(local, 'spans', None)
+    if parents is None:
+        parents = local.spans = []
+
+    fields = dict(data)
+    started = now()
+    parents.append(name)
+
+    try:
+        with sentry_sdk.start_span(op=name) as sentry_span:
+            yield fields
+
+            for key, value in fields.items():
+                sentry_span.set_data(key, value)
+    finally:
+        parents.pop()
+        record(name, started, parent=parents[-1] if parents else None, **fields)
+
+
+@contextmanager
+def transaction(name):
+    # a sentry transaction continuing the job's trace
+    global open_transactions
+
+    open_transactions += 1
+    try:
+        with sentry_sdk.start_transaction(op='job', name=name, trace_id=environ().get(TRACE_ID_ENV)):
+            with span(name):
+                yield
+    finally:
+        open_transactions -= 1
+
+
+def begin(name):
+    # for scripts run as their own process, the warm blender worker already
+    # wraps each script in a transaction
+    if open_transactions:
+        return
+
+    script_transactions.enter_context(transaction(name))
+
+
+atexit.register(script_transactions.close)
+
+
+@contextmanager
+def trace(name, workspace, trace_id=None):
+    # starts a job's trace, or joins the one already running when a job is
+    # handled in-process by another, e.g. a local shard; trace_id continues
+    # a trace started on another machine
+    if TRACE_ID_ENV in environ():
+        with span(name):
+            yield None
+        return
+
+    trace_id = trace_id or uuid.uuid4().hex
+    job_trace = {'trace_id': trace_id,
+                 'file': os.path.join(workspace, 'trace-{}.jsonl'.format(trace_id))}
+    token = current_trace.set(job_trace)
+
+    try:
+        with transaction(name):
+            yield job_trace
+    finally:
+        current_trace.reset(token)
+
+
+def report(job_trace):
+    # the job's spans from every process, plus seconds spent per phase
+    spans = []
+
+    if os.path.exists(job_trace['file']):
+        with open(job_trace['file'], 'r') as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+        os.remove(job_trace['file'])
+
+    totals = {}
+    for record in spans:
+        totals[record['name']] = round(
+            totals.get(record['name'], 0) + record['seconds'], 4)
+
+    return {
+        'trace_id': job_trace['trace_id'],
+        'totals': totals,
+        'spans': sorted(spans, key=lambda record: record['start']),
+    }
@@ -0,0 +1,68 @@
+import os
+import math
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache, tracing
+
+
+FPS = 30
+VIDEO_CODEC = 'libx264'
+AUDIO_CODEC = 'aac'
+
+# each transcode is its own ffmpeg process, threads only wait on them
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get(
+    'TRANSCODE_WORKERS', max(1, (os.cpu_count() or 2) // 2))))
+
+
+def segment_frames(segment_data, fps=FPS):
+    # whole frames covering the segment, so cut files line up with the
+    # sequencer's frame grid
+    return math.floor(segment_data["start"] * fps), math.ceil(segment_data["end"] * fps)
+
+
+def transcode_segment(source_path, source_key, source_etag, frame_start, frame_end, output_path, fps=FPS):
+    # source_etag is the downloaded version of source_key, segments of an
+    # unknown version aren't cached
+    transcode_cache = cache.default_cache()
+
+    def produce(path):
+        proc = subprocess.run([
+            'ffmpeg',
+            '-ss', str(frame_start / fps),
+            '-i', source_path,
+            '-t', str((frame_end - frame_start) / fps),
+            '-filter:v', 'fps={}'.format(fps),
+            '-vcodec', VIDEO_CODEC,
+            '-acodec', AUDIO_CODEC,
+            '-f', 'mp4',
+            '-y',
+            path
+        ])
+
+        if proc.returncode != 0:
+            raise Exception("error transcoding {}".format(source_key))
+
+    with tracing.span('transcode', key=source_key, frame_start=frame_start, frame_end=frame_end):
+        if source_etag is None:
+            produce(output_path)
+            return output_path
+
+        key = transcode_cache.key('transcode', source_key, source_etag,
+                                  frame_start, frame_end, fps, VIDEO_CODEC, AUDIO_CODEC)
+
+        return transcode_cache.fetch(key, output_path, produce)
+
+
+def transcode_segments(source_future, source_key, segments, output_prefix, source_etag, fps=FPS):
+    # segments maps a name to its transcription segment, returns a future
+    # per segment that resolves to the cut and normalized file; source_etag
+    # maps the downloaded source path to its version
+    def transcode(name, segment_data):
+        frame_start, frame_end = segment_frames(segment_data, fps)
+        source_path = source_future.result()
+
+        return transcode_segment(source_path, source_key, source_etag(source_path), frame_start, frame_end,
+                                 "{}.{}.mp4".format(output_prefix, name), fps)
+
+    return {name: executor.submit(transcode, name, segment_data) for name, segment_data in segments.items()}
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import socket
+import subprocess
+import threading
+
+
+class BlenderWorker:
+    def __init__(self, blender_bin, socket_path, max_jobs=50, max_memory=8 * 1024 ** 3):
+        self.blender_bin = blender_bin
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.proc = None
+        # one job at a time per blender process
+        self.lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.proc = subprocess.Popen([self.blender_bin, "--background", "--python-exit-code", "1",
+                                      "--python", os.path.join(os.path.dirname(__file__), '..', 'blender_worker.py'), "--",
+                                      "--socket", self.socket_path,
+                                      "--max_jobs", str(self.max_jobs),
+                                      "--max_memory", str(self.max_memory)])
+
+    def connect(self, timeout=120):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if self.proc.poll() is not None:
+                raise Exception(
+                    "blender worker exited with {}".format(self.proc.returncode))
+
+            try:
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.connect(self.socket_path)
+                return conn
+            except (FileNotFoundError, ConnectionRefusedError):
+                conn.close()
+
+                if time.monotonic() > deadline:
+                    raise Exception("blender worker did not start")
+
+                time.sleep(0.1)
+
+    def run(self, script, args, blend=None, env=None):
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+
+            with self.connect() as conn, conn.makefile('rw') as stream:
+                stream.write(json.dumps(
+                    {'script': script, 'args': args, 'blend': blend, 'env': env or {}}) + '\n')
+                stream.flush()
+
+                line = stream.readline()
+
+            if not line:
+                # crashed mid-job, the next run starts a fresh process
+                self.proc.wait()
+                raise Exception("blender worker died running {}".format(script))
+
+            result = json.loads(line)
+
+            if result['recycle']:
+                self.proc.wait()
+                self.start()
+
+            if not result['ok']:
+                raise Exception(result['error'])
+
+            return result